@@ -12,17 +12,22 @@
     # install xvfb and chromium
         # sudo apt-get update
         # sudo apt-get install xvfb chromium-browser
-    # install older version of chromedriver manually:
-        # Linux:https://chromedriver.storage.googleapis.com/index.html?path=2.26/
+    # install a chromedriver matching the installed Chrome/Chromium manually:
+        # Linux: https://chromedriver.storage.googleapis.com/index.html
         # Download and extract the appropriate archive somewhere.
         # Open a terminal wherever the executable is (or use its full filepath)
             # sudo mv chromedriver /usr/bin/chromedriver
+    # Changing the download folder of a running browser (set_save_path, used
+    # by browser_pool.py) and downloading in headless mode use Chrome DevTools
+    # Protocol commands, which need Selenium 3.141 or later and a chromedriver
+    # recent enough to accept them (2.26, used originally, is not). With an
+    # older setup, set_save_path falls back to restarting the browser with the
+    # new download folder, and headless mode can't download.
 
 import os
 import glob
 import time
-import signal
-import subprocess
+import shutil
 from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException, WebDriverException, StaleElementReferenceException
 from selenium.webdriver.common.by import By
@@ -36,7 +41,7 @@ from check_os import is_VM
 class JS_browser:
 
     def __init__(self, save_path, invisible = True, start_link = False,
-        download_wait = 600, verbose = False):
+        download_wait = 600, verbose = False, headless = False):
         '''
         Open a web browser, optionally navigating to a page. This browser can
         be used to click on elements within the page, which is particularly
@@ -45,22 +50,58 @@ class JS_browser:
         Must include valid folder in "save_path" to specify where the downloads
         will go, preferably one that's empty before this class is used to do
         anything.
+
+        With headless = True, Chrome runs in its own headless mode with images
+        turned off, rather than as a normal browser window (in a virtual
+        display when "invisible"). This takes far less memory and CPU, so more
+        browsers can run side by side.
         '''
-        self._invisible = invisible
+        # A headless browser needs no display, virtual or otherwise.
+        self._invisible = invisible and not headless
+        self._headless = headless
         self._verbose = verbose
         self._download_wait = self._validate_time(download_wait, 600)
         self._save_path = save_path
+        # Whether chromedriver accepts DevTools commands (see set_save_path)
+        self._cdp = True
 
         if self._invisible:
             self._display = Display(visible = 0, size = (800, 600))
             self._display.start()
         
+        self._start_driver()
+        if headless:
+            # Headless Chrome ignores the download preference and refuses
+            # downloads unless told where to put them.
+            self.set_save_path(self._save_path)
+            if not self._cdp:
+                print("WARNING: chromedriver doesn't accept DevTools "
+                        "commands; headless browser won't be able to "
+                        "download files.")
+        
+        if start_link:
+            self.go_to(start_link)
+
+
+    def _start_driver(self):
+        '''
+        Start Chrome (headless if the browser was created that way),
+        downloading into the current save path.
+        '''
         # Set the default download directory, since we can't rely on a dialog
         # box to control the location to which files download.
         #
         # http://stackoverflow.com/questions/36982639/changing-default-download-location-in-chrome-using-python-selenium
         chrome_options = webdriver.ChromeOptions()
         prefs = {"download.default_directory" : self._save_path}
+        if self._headless:
+            # Don't load images, which nothing here looks at.
+            prefs["profile.managed_default_content_settings.images"] = 2
+            chrome_options.add_argument("--headless")
+            chrome_options.add_argument("--disable-gpu")
+            chrome_options.add_argument("--disable-extensions")
+            chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+            chrome_options.add_argument("--window-size=1280,1024")
         chrome_options.add_experimental_option("prefs", prefs)
         if is_VM():
             chromedriver = "/usr/bin/chromedriver"
@@ -71,9 +112,6 @@ class JS_browser:
         # Selenium functionality to a number of seconds for page elements to
         # appear if not immediately present when a function looks for them.
         self._driver.implicitly_wait(10)
-        
-        if start_link:
-            self.go_to(start_link)
 
 
     def _validate_time(self, user_input, default):
@@ -110,24 +148,70 @@ class JS_browser:
                 print("Loading page failed. Check link is valid.")
  
 
-    def wait_for_page_to_load(self):
+    def _wait_until(self, condition, timeout = None, first_delay = 0.05,
+        max_delay = 0.5):
+        '''
+        Calls "condition" until it returns something true, and returns that.
+        Checks start "first_delay" seconds apart and back off to at most
+        "max_delay" seconds, so short waits end almost as soon as the
+        condition holds without hammering the browser during long ones.
+        Gives up and returns None after "timeout" seconds (None to wait
+        forever).
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        delay = first_delay
+        while True:
+            result = condition()
+            if result:
+                return result
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+    def _page_is_idle(self):
         '''
-        Checks for an element on the page that indicates some JavaScript
-        element is loading, which means other desired actions should wait.
+        Returns True unless an element on the page indicates some JavaScript
+        element is loading.
         '''
         loading_icon_path = '//img[@class="dxlp-loadingImage dxlp-imgPosLeft"]'
-        # Note that this says "find_elements", not "find_element"
-        loading_icons = self._driver.find_elements_by_xpath(loading_icon_path)
-        not_loaded = True
-        while not_loaded:
-            try:
-                while any([icon.is_displayed() for icon in loading_icons]):
-                    time.sleep(1)
-                not_loaded = False
-            except StaleElementReferenceException:
-                # Occasionally there are issues if these references haven't
-                # been updated.
-                loading_icons = self._driver.find_elements_by_xpath(loading_icon_path)
+        # Without the implicit wait, a page with no loading icon is found
+        # idle at once instead of after the 10 seconds Selenium would wait
+        # for an icon to appear.
+        self._driver.implicitly_wait(0)
+        try:
+            # Note that this says "find_elements", not "find_element"
+            loading_icons = self._driver.find_elements_by_xpath(
+                                loading_icon_path)
+            return not any([icon.is_displayed() for icon in loading_icons])
+        except StaleElementReferenceException:
+            # The page changed while the icons were being checked.
+            return False
+        finally:
+            self._driver.implicitly_wait(10)
+
+
+    def wait_for_page_to_load(self, settle = 0):
+        '''
+        Waits while an element on the page indicates some JavaScript element
+        is loading, which means other desired actions should wait. With
+        "settle" > 0, the page must also stay that way for "settle" seconds,
+        for changes that set off further loading a moment later.
+        '''
+        self._wait_until(self._page_is_idle)
+        if settle:
+            idle_since = [time.monotonic()]
+            def settled():
+                if not self._page_is_idle():
+                    idle_since[0] = time.monotonic()
+                return time.monotonic() - idle_since[0] >= settle
+            self._wait_until(settled)
 
 
     def wait_for_clickable(self, element):
@@ -167,6 +251,36 @@ class JS_browser:
             self.wait_for_page_to_load()
 
 
+    def click_all(self, elements):
+        '''
+        Within the browser, click every element in the list "elements" (given
+        by XPath) in a single script run on the page, then allow the page
+        to respond once. Much faster than calling click for each element when
+        ticking many checkboxes, since click waits for the page after every
+        one. Elements that aren't on the page are skipped.
+        '''
+        if not elements:
+            return None
+        # document.evaluate finds an element by XPath in the page itself.
+        script = '''
+            var missing = [];
+            for (var i = 0; i < arguments[0].length; i++) {
+                var element = document.evaluate(arguments[0][i], document,
+                    null, XPathResult.FIRST_ORDERED_NODE_TYPE,
+                    null).singleNodeValue;
+                if (element) {
+                    element.click();
+                } else {
+                    missing.push(arguments[0][i]);
+                }
+            }
+            return missing;'''
+        missing = self._driver.execute_script(script, list(elements))
+        if missing and self._verbose:
+            print("Could not find elements to click: {}".format(missing))
+        self.wait_for_page_to_load()
+
+
     def enter_text(self, element, text):
         '''
         Within the browser, populate the text field indicated by "element" with
@@ -202,7 +316,11 @@ class JS_browser:
         instance and the procedure the webpage uses for generating a download
         file name (this has to be empirically determined). By default this is
         set to timeout downloads after 10 minutes, which can help avoid
-        infinite loops caused by mistyping file paths.
+        infinite loops caused by mistyping file paths; "force_dowload_wait"
+        sets a different limit in seconds for this download, or False for
+        none. If the limit is reached, JS_browser.TimeExceededException is
+        raised. The wait is checked against a deadline rather than a signal,
+        so browsers can be driven from any thread or process.
 
         "is_simple" == False and "ext" != None should be used when a web page
         includes unpredictable strings in the file names for downloads; in such
@@ -218,31 +336,26 @@ class JS_browser:
             i = 1
             while os.path.exists(try_name.format(i)):
                 i += 1
-            default_save_path = try_name
+            default_save_path = try_name.format(i)
 
-        if force_dowload_wait:
+        if force_dowload_wait is not None:
             max_time = self._validate_time(force_dowload_wait,
-                                            self._dowload_wait)
+                                            self._download_wait)
         else:
             max_time = self._download_wait
 
-        # By now, max_time is either something numeric or "False".
-        if max_time:
-            self.click(element)
-            updated_path = self._timed_download(default_save_path, max_time,
-                                                is_simple, ext)
-        else:
-            self.click(element)
-            updated_path = self._download(default_save_path, is_simple, ext)
+        # By now, max_time is either something numeric or "False"; either
+        # False or 0 means no limit.
+        self.click(element)
+        updated_path = self._download(default_save_path, is_simple, ext,
+                                        timeout = max_time or None)
 
         if updated_path:
             default_save_path = updated_path
         if output_path:
-            bash_command = ("mv " + r"\ ".join(default_save_path.split()) +
-                            " " + output_path)
-            # If there's an issue with the specified output path, an error
-            # gets printed to the terminal automatically.
-            subprocess.Popen(bash_command, shell = True)
+            # Moved before returning, so the file is at output_path as soon
+            # as this returns.
+            shutil.move(default_save_path, output_path)
         return None
 
 
@@ -253,47 +366,32 @@ class JS_browser:
             pass
 
 
-    def _timed_download(self, filepath, time_allowed, is_simple = True,
-        ext = None):
+    def _download(self, filepath, is_simple = True, ext = None,
+        timeout = None):
         '''
-        Check if a download has successfully completed, enforcing a time-out.
-        '''
-        # Based on suggestions from 
-        # http://stackoverflow.com/questions/492519/timeout-on-a-function-call
-        def handler(signum, frame):
-            raise JS_browser.TimeExceededException
-        timeout_handler = signal.signal(signal.SIGALRM, handler)
-        try:
-            alarm = signal.alarm(time_allowed)
-            updated_path = self._download(filepath, is_simple, ext)
-            alarm = signal.alarm(0)
-            return updated_path
-        except JS_browser.TimeExceededException:
-            if self._verbose:
-                print("Download Failed: Maximum download time exceeded.\n"
-                      "If this is unexpected, ensure file paths were entered "
-                      "properly.")
-            return None
-
-
-    def _download(self, filepath, is_simple = True, ext = None):
-        '''
-        Check if a download has successfully completed. This WILL hang if the
-        file is specified improperly.
+        Check if a download has successfully completed, waiting up to
+        "timeout" seconds (None to wait as long as it takes, which WILL hang
+        if the file is specified improperly) before raising
+        JS_browser.TimeExceededException. Returns the path of the download if
+        its name wasn't predictable (is_simple = False).
+
+        Chrome writes a download to <name>.crdownload and only renames it to
+        its real name once it is complete, so the file appearing under its
+        real name means it is done.
         '''
+        if self._verbose:
+            print("\n Waiting for download to finish at {}".format(filepath))
         if is_simple:
-            while not os.path.exists(filepath):
-                time.sleep(1)
-                if self._verbose:
-                    print("\n Waiting for download to finish at {}".format(
-                            filepath))
+            if not self._wait_until(lambda: os.path.exists(filepath),
+                                    timeout):
+                self._download_timed_out(filepath, timeout)
             return None
         else:
             # is_simple = False is used when the web interface inserts
             # character strings into the the filename, such that the downloaded
             # file's name is unpredictable. This solution is based on
             # http://stackoverflow.com/questions/4296138/use-wildcard-with-os-path-isfile
-            list_of_possible_dl_files = glob.glob(filepath + '*' + ext)
+            list_of_possible_dl_files = self._finished_downloads(filepath, ext)
             if len(list_of_possible_dl_files) > 1:
                 raise RuntimeError(
                       "\n User indicated download file name is not completely "
@@ -302,16 +400,93 @@ class JS_browser:
                       "files in the default download directory that have the "
                       "same extension as the one you are downloading. Be very "
                       "careful when using this option. \n")
-            while len(list_of_possible_dl_files) < 1:
-                # periodically check for the presence of the completed download
-                time.sleep(1)
-                if self._verbose:
-                    print("\n Waiting for download to finish at {}".format(
-                            filepath))
-                list_of_possible_dl_files = glob.glob(filepath + '*' + ext)
+            list_of_possible_dl_files = self._wait_until(
+                lambda: self._finished_downloads(filepath, ext), timeout)
+            if not list_of_possible_dl_files:
+                self._download_timed_out(filepath, timeout)
             return list_of_possible_dl_files[0]
 
 
+    def _download_timed_out(self, filepath, timeout):
+        '''
+        Report a download that didn't finish in time.
+        '''
+        if self._verbose:
+            print("Download Failed: Maximum download time exceeded.\n"
+                  "If this is unexpected, ensure file paths were entered "
+                  "properly.")
+        raise JS_browser.TimeExceededException(
+            "Download to {} not finished after {} seconds".format(filepath,
+                                                                 timeout))
+
+
+    def _finished_downloads(self, filepath, ext):
+        '''
+        Completed downloads whose names start with "filepath" and end with
+        "ext", leaving out any still being written by Chrome.
+        '''
+        return [name for name in glob.glob(filepath + '*' + ext)
+                if not name.endswith('.crdownload')]
+
+
+    def _execute_cdp_cmd(self, cmd, args):
+        '''
+        Run a Chrome DevTools Protocol command. Returns False, and remembers
+        not to try again, if Selenium or chromedriver is too old to run it.
+        '''
+        if not self._cdp:
+            return False
+        try:
+            self._driver.execute_cdp_cmd(cmd, args)
+            return True
+        except (AttributeError, WebDriverException):
+            self._cdp = False
+            return False
+
+
+    def set_save_path(self, save_path):
+        '''
+        Change the folder the browser downloads into to "save_path". Without
+        DevTools support (see the top of this file), the browser is restarted
+        with the new folder instead; the current page is not kept.
+        '''
+        changed = save_path != self._save_path
+        self._save_path = save_path
+        if self._execute_cdp_cmd("Page.setDownloadBehavior",
+                                    {"behavior": "allow",
+                                     "downloadPath": save_path}):
+            return None
+        if changed:
+            self._driver.quit()
+            self._start_driver()
+        return None
+
+
+    def reset(self, save_path = None):
+        '''
+        Prepare the browser to be used again for something else, as when it
+        is reused from a browser_pool.BrowserPool: forgets cookies (so no
+        search state carries over), leaves the current page, and optionally
+        changes the download folder to "save_path".
+        '''
+        if not self._execute_cdp_cmd("Network.clearBrowserCookies", {}):
+            self._driver.delete_all_cookies()
+        self._driver.get("about:blank")
+        if save_path:
+            self.set_save_path(save_path)
+
+
+    def is_alive(self):
+        '''
+        Returns True if the browser still responds to commands.
+        '''
+        try:
+            self._driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+
     def cleanup(self):
         '''
         Close the browser (and stop the virtual display, if the browser is
@@ -0,0 +1,82 @@
+# CS122 Project
+#
+# Vishok Srikanth / MVR
+#
+# On-disk cache of the abstracts scraped from TAGGS Award Detail pages, so
+# that collections for overlapping years and the temporary searches made by
+# manage_temp_db.py don't fetch the same pages again. Renewals of a grant
+# share an Award Detail page, so abstracts are keyed by the award number
+# found in the page's link (see award_links_from_page in collect_TAGG.py).
+
+import time
+import sqlite3
+
+# Abstracts older than this many seconds are fetched again (90 days).
+DEFAULT_TTL = 90 * 24 * 60 * 60
+
+
+class AbstractCache:
+
+    def __init__(self, db_filename, ttl = DEFAULT_TTL):
+        '''
+        Open (creating it if needed) the SQLite database at "db_filename"
+        holding cached abstracts. Entries older than "ttl" seconds are treated
+        as missing; ttl = None keeps entries forever.
+        '''
+        self._ttl = ttl
+        # Several collection processes may share the cache, so wait for
+        # another writer's lock rather than failing straight away.
+        self._conn = sqlite3.connect(db_filename, timeout = 60)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS abstracts
+                                (award_number text,
+                                 abstract text,
+                                 fetched_at real,
+                                 constraint pk_abstracts
+                                 primary key (award_number));''')
+        self._conn.commit()
+
+
+    def get_many(self, award_numbers):
+        '''
+        Returns a dictionary mapping award number : abstract for those of
+        "award_numbers" that are in the cache and not expired.
+        '''
+        award_numbers = list(award_numbers)
+        oldest = 0
+        if self._ttl is not None:
+            oldest = time.time() - self._ttl
+        found = {}
+        # Stay under SQLite's limit on the number of query parameters.
+        for i in range(0, len(award_numbers), 500):
+            chunk = award_numbers[i:i + 500]
+            rows = self._conn.execute('''SELECT award_number, abstract
+                                         FROM abstracts
+                                         WHERE fetched_at >= ? AND
+                                         award_number IN ({});'''.format(
+                                            ', '.join(['?'] * len(chunk))),
+                                        [oldest] + chunk).fetchall()
+            found.update(rows)
+        return found
+
+
+    def put_many(self, abstracts):
+        '''
+        Stores a dictionary mapping award number : abstract, stamping each
+        entry with the current time. Abstracts that are None (fetch failed)
+        are not stored.
+        '''
+        now = time.time()
+        self._conn.executemany('''INSERT OR REPLACE INTO abstracts
+                                  (award_number, abstract, fetched_at)
+                                  VALUES (?, ?, ?);''',
+                                [(award_number, abstract, now) for
+                                    (award_number, abstract) in
+                                    abstracts.items() if abstract is not None])
+        self._conn.commit()
+
+
+    def close(self):
+        '''
+        Close the cache database.
+        '''
+        self._conn.close()
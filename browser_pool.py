@@ -0,0 +1,207 @@
+# CS122 Project
+#
+# Vishok Srikanth / MVR
+#
+# A pool of JS_browser instances that are kept running between uses. Starting
+# a browser (and its virtual display) takes several seconds, which used to be
+# paid by every search made through manage_temp_db.py and by every state of a
+# TAGGS collection. Browsers taken from a pool are reset between uses instead
+# (see JS_browser.reset), checked to still be responsive, and replaced after a
+# set number of uses so that a long-running browser can't slowly go bad.
+
+import threading
+from contextlib import contextmanager
+from JS_browser import JS_browser
+
+
+class BrowserPool:
+
+    def __init__(self, size = 2, max_uses = 25, **browser_options):
+        '''
+        Holds up to "size" browsers, each retired after "max_uses" uses. Any
+        keyword arguments are passed to JS_browser when a browser is started.
+        Browsers are started as they are first needed; use warm_up to start
+        some ahead of time (get_pool does this for the shared pool).
+        '''
+        self._size = size
+        self._max_uses = max_uses
+        self._browser_options = browser_options
+        self._idle = []
+        self._uses = {}
+        self._in_use = 0
+        self._starting = 0 # Browsers being started by warm_up
+        self._closed = False
+        self._condition = threading.Condition()
+
+
+    def _start_browser(self, save_path):
+        browser = JS_browser(save_path, **self._browser_options)
+        self._uses[browser] = 0
+        return browser
+
+
+    def _retire(self, browser):
+        '''
+        Quit a browser that is leaving the pool, ignoring errors from one
+        that has already died.
+        '''
+        self._uses.pop(browser, None)
+        try:
+            browser.cleanup()
+        except Exception:
+            pass
+
+
+    def warm_up(self, count = None, save_path = "/tmp/"):
+        '''
+        Start browsers until "count" (by default the pool size) are idle and
+        ready to use. Browsers are started one at a time without holding the
+        pool's lock, so the pool can be used in the meantime; a caller of
+        acquire waits for a browser being started here rather than starting
+        another.
+        '''
+        if count is None:
+            count = self._size
+        while True:
+            with self._condition:
+                if (self._closed or
+                        len(self._idle) + self._starting >= count or
+                        len(self._idle) + self._starting + self._in_use >=
+                        self._size):
+                    return
+                self._starting += 1
+            browser = None
+            try:
+                browser = self._start_browser(save_path)
+            finally:
+                with self._condition:
+                    self._starting -= 1
+                    if browser is not None and not self._closed:
+                        self._idle.append(browser)
+                        browser = None
+                    self._condition.notify()
+            if browser is not None:
+                # The pool was closed while the browser was starting.
+                self._retire(browser)
+                return
+
+
+    def acquire(self, save_path, start_link = False, timeout = None):
+        '''
+        Take a browser from the pool, starting one if none is idle and the
+        pool isn't full, or otherwise waiting up to "timeout" seconds (None to
+        wait as long as needed) for one to be released. The browser is reset
+        to download into "save_path", and navigated to "start_link" if given.
+        Browsers that fail the health check (JS_browser.is_alive) are
+        replaced.
+        '''
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Browser pool has been closed.")
+            if not self._condition.wait_for(
+                    lambda: self._idle or (not self._starting and
+                        self._in_use < self._size),
+                    timeout):
+                raise TimeoutError("No browser became available within "
+                                    "{} seconds.".format(timeout))
+            browser = self._idle.pop() if self._idle else None
+            self._in_use += 1
+
+        try:
+            if browser is not None and not browser.is_alive():
+                self._retire(browser)
+                browser = None
+            if browser is None:
+                browser = self._start_browser(save_path)
+            else:
+                browser.reset(save_path)
+            self._uses[browser] += 1
+            if start_link:
+                browser.go_to(start_link)
+        except Exception:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            if browser is not None:
+                self._retire(browser)
+            raise
+        return browser
+
+
+    def release(self, browser, healthy = True):
+        '''
+        Return a browser taken with acquire. Browsers that have reached
+        "max_uses", or that the caller reports as not "healthy" (e.g., after
+        an error part way through a search), are quit rather than reused.
+        '''
+        retire = (not healthy or self._closed or
+                    self._uses.get(browser, 0) >= self._max_uses)
+        if retire:
+            self._retire(browser)
+        with self._condition:
+            self._in_use -= 1
+            if not retire:
+                self._idle.append(browser)
+            self._condition.notify()
+
+
+    @contextmanager
+    def browser(self, save_path, start_link = False, timeout = None):
+        '''
+        Use a browser from the pool in a with statement; it is released when
+        the block ends, or retired if the block raises an error.
+        '''
+        browser = self.acquire(save_path, start_link, timeout)
+        try:
+            yield browser
+        except BaseException:
+            self.release(browser, healthy = False)
+            raise
+        self.release(browser)
+
+
+    def close(self):
+        '''
+        Quit all idle browsers. Browsers still in use are quit as they are
+        released.
+        '''
+        with self._condition:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+        for browser in idle:
+            self._retire(browser)
+
+
+# Pool shared by everything in this process that asks for it (see get_pool).
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def get_pool(**pool_options):
+    '''
+    Returns this process's shared BrowserPool, creating it (with
+    "pool_options", as for BrowserPool) the first time it is asked for. As
+    with JS_browser, its browsers run in a virtual display unless given
+    headless = True. One browser is started in the background as soon as the
+    pool is created.
+    '''
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = BrowserPool(**pool_options)
+            # Start the first browser in the background, so that it is
+            # (nearly) ready by the time the first search needs it.
+            threading.Thread(target = _warm_up_quietly, args = (_shared_pool,),
+                                daemon = True).start()
+        return _shared_pool
+
+
+def _warm_up_quietly(pool):
+    '''
+    Start one browser in "pool". Errors are ignored, since acquire starts a
+    browser itself if none is ready.
+    '''
+    try:
+        pool.warm_up(1)
+    except Exception:
+        pass
@@ -0,0 +1,144 @@
+# Buffered writer for loading award rows into the SQLite award databases
+#
+# Mark Saddler, Vishok Srikanth / MVR
+#
+# The scrapers (nsf_scrape.py, nsf_scrape_search_result.py, collect_TAGG.py)
+# turn each award into one row for the awards table plus rows for the
+# investigators, institutions and organizations tables. Inserting these one
+# statement at a time, each in SQLite's default journaled mode, is what makes
+# building nsf.db and the taggs_*.db files slow. BulkWriter buffers the rows
+# per table and writes each batch with executemany inside one transaction.
+
+# Column order for the rows of each table in nsf.db (see init_db in
+# nsf_scrape.py).
+AWARD_TABLE_COLUMNS = {
+    'awards': ['award_id', 'title', 'abstract', 'amount', 'start_date',
+               'end_date'],
+    'investigators': ['award_id', 'last_name', 'first_name', 'role', 'email'],
+    'institutions': ['award_id', 'name', 'address', 'city', 'state',
+                     'zipcode', 'country'],
+    'organizations': ['award_id', 'organization_code', 'directorate',
+                      'division'],
+    }
+
+# The TAGGS databases also record the agency of each award (see connect_db in
+# collect_TAGG.py).
+TAGG_TABLE_COLUMNS = dict(AWARD_TABLE_COLUMNS)
+TAGG_TABLE_COLUMNS['awards'] = ['award_id', 'agency', 'title', 'abstract',
+                                'amount', 'start_date', 'end_date']
+
+# Settings for bulk loads: write-ahead logging without a sync on every
+# commit. Each batch is still committed atomically, so a load that is killed
+# part way keeps every batch committed before that point (nsf_scrape.py
+# relies on this to resume interrupted runs). close() switches the database
+# back to the default rollback journal so it stays a single file.
+BULK_LOAD_PRAGMAS = ['PRAGMA journal_mode = WAL',
+                     'PRAGMA synchronous = NORMAL',
+                     'PRAGMA temp_store = MEMORY',
+                     'PRAGMA cache_size = -65536']
+
+
+class BulkWriter:
+
+    def __init__(self, conn, table_columns, batch_size = 10000,
+        bulk_load = True):
+        '''
+        Buffer rows for the tables in "table_columns" (a dictionary mapping
+        table name : list of column names, e.g. AWARD_TABLE_COLUMNS) and write
+        them to the database behind the sqlite3 connection "conn" with
+        INSERT OR REPLACE statements.
+
+        Rows are flushed with one executemany per table and committed as a
+        single transaction every "batch_size" rows. "bulk_load" applies
+        BULK_LOAD_PRAGMAS to the connection first.
+        '''
+        self._conn = conn
+        self._cursor = conn.cursor()
+        self._table_columns = table_columns
+        self._batch_size = batch_size
+        self._bulk_load = bulk_load
+        self._pending = 0
+        self._deletes = {}
+        self._rows = {table: [] for table in table_columns}
+        self._statements = {}
+        for (table, columns) in table_columns.items():
+            self._statements[table] = (
+                'INSERT OR REPLACE INTO {} ({}) VALUES ({});'.format(
+                    table, ', '.join(columns),
+                    ', '.join(['?'] * len(columns))))
+        if bulk_load:
+            # journal_mode can't be changed inside an open transaction.
+            self._conn.commit()
+            for pragma in BULK_LOAD_PRAGMAS:
+                self._cursor.execute(pragma)
+
+
+    def add(self, table, row):
+        '''
+        Buffer a single row (a tuple ordered like the columns given for
+        "table"), flushing if a full batch has built up.
+        '''
+        self._rows[table].append(row)
+        self._pending += 1
+        if self._pending >= self._batch_size:
+            self.flush()
+
+
+    def delete(self, table, column, value):
+        '''
+        Buffer the deletion of all rows of "table" whose "column" equals
+        "value". Deletes are carried out at the start of the next flush,
+        before any buffered rows are inserted, so they can be used to clear
+        out an award's old rows before queuing its new ones.
+        '''
+        self._deletes.setdefault((table, column), []).append((value,))
+        self._pending += 1
+
+
+    def add_rows(self, table_rows):
+        '''
+        Buffer the rows in a dictionary mapping table name : list of rows, as
+        returned by the get_*_rows functions of the scrapers. All of them go
+        into the same batch, so they are committed together.
+        '''
+        for (table, rows) in table_rows.items():
+            self._rows[table].extend(rows)
+            self._pending += len(rows)
+        if self._pending >= self._batch_size:
+            self.flush()
+
+
+    def discard(self):
+        '''
+        Drop all buffered rows and deletes without writing them, e.g. after
+        an error part way through rows that must be committed together.
+        '''
+        self._deletes = {}
+        self._rows = {table: [] for table in self._table_columns}
+        self._pending = 0
+
+
+    def flush(self):
+        '''
+        Write all buffered rows and commit them as one transaction.
+        '''
+        for ((table, column), values) in self._deletes.items():
+            self._cursor.executemany('DELETE FROM {} WHERE {} = ?;'.format(
+                                        table, column), values)
+        self._deletes = {}
+        for (table, rows) in self._rows.items():
+            if rows:
+                self._cursor.executemany(self._statements[table], rows)
+                self._rows[table] = []
+        self._pending = 0
+        self._conn.commit()
+
+
+    def close(self):
+        '''
+        Flush any remaining rows and undo the bulk load journal setting. The
+        connection itself is left open for the caller to close.
+        '''
+        self.flush()
+        if self._bulk_load:
+            self._cursor.execute('PRAGMA journal_mode = DELETE')
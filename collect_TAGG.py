@@ -9,6 +9,7 @@
 
 import bs4
 import re
+import csv
 import requests
 import time
 import pandas as pd
@@ -16,14 +17,49 @@ import subprocess
 import sys
 import os
 import sqlite3
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from lxml import html as lxml_html
+from requests.adapters import HTTPAdapter
 from populate_TAGG_search import search
 from JS_browser import JS_browser
+from taggs_http import TAGGS_client
+from browser_pool import BrowserPool, get_pool
+from multiprocessing.util import Finalize
 from selenium.common.exceptions import WebDriverException
 from check_os import is_VM
+from bulk_writer import BulkWriter, TAGG_TABLE_COLUMNS
+from abstract_cache import AbstractCache
+
+# Defaults for fetching abstracts from the Award Detail pages: how many pages
+# to fetch at once, the most requests per second to send to the TAGGS site
+# (None for no limit), and how many times to retry a failed request.
+ABSTRACT_WORKERS = 8
+ABSTRACT_RATE_LIMIT = 10
+ABSTRACT_RETRIES = 3
+# How many rows of a TAGGS export stream_awards reads ahead of the row it is
+# writing, so that their abstracts are being fetched in the meantime.
+STREAM_WINDOW = 64
+
+START_PAGE = "https://taggs.hhs.gov/SearchAdv"
+DOWNLOAD_ELEMENT = '//*[@id="btnExportToCSVSearchAdvExport_AdvSearchFilter"]'
+# Recipient states on the TAGGS Advanced Search page, in the order listed
+# there. Grants awarded outside the US are collected separately as "INTL".
+TAGGS_STATES = ['AL', 'AK', 'AS', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC',
+                'FM', 'FL', 'GA', 'GU', 'HI', 'ID', 'IL', 'IN', 'IA', 'JQ',
+                'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO',
+                'MT', 'MQ', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND',
+                'MP', 'BQ', 'OH', 'OK', 'OR', 'PA', 'PR', 'MH', 'PW', 'RI',
+                'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VI', 'VA', 'WA', 'WV',
+                'WI', 'WY', 'WQ']
 
 def process_results(browser, default_save_path, output_path = None,
     download_element = "", is_simple = False, ext = ".csv",
-    check_count = False, verbose = False):
+    check_count = False, verbose = False, abstract_workers = ABSTRACT_WORKERS,
+    rate_limit = ABSTRACT_RATE_LIMIT, cache = None, writer = None,
+    release_browser = None):
     '''
     Walks through the pages of a TAGGS Advanced Search result, and:
         (0) Optionally, checks that the number of rows returned is under the
@@ -31,10 +67,12 @@ def process_results(browser, default_save_path, output_path = None,
         (1) Downloads the CSV containing search results not including abstracts
         (2) Makes a list of the links to all Award Detail pages for Awards
             returned
-        (3) Cleans up the JS_browser object
+        (3) Cleans up the JS_browser object (or, if "release_browser" is
+            given, calls release_browser(browser) instead, e.g. to return it
+            to a browser_pool.BrowserPool)
         (4) Visits each of the Award Detail pages and extracts an abstract
         (5) Returns a dictionary mapping Award Number : Abstract, which can be
-            added to the downloaded data relatively easily
+            added to the downloaded data with merge_abstracts
 
     "browser" should be a JS_browser navigated to the search result page.
     Default options for keyword arguments are set to make this succinct, since
@@ -44,29 +82,53 @@ def process_results(browser, default_save_path, output_path = None,
     "default_save_path", "is_simple", and "ext" are utilized as in the download
     method for the JS_browser class
 
-    "check_count" prints a warning if 10,000 rows were exported, since this is
-    the maximum value and suggests that some rows were probably excluded
+    "check_count" (used when streaming, see below) prints a warning if 10,000
+    rows were exported, since this is the maximum value and suggests that
+    some rows were probably excluded
+
+    "abstract_workers", "rate_limit" and "cache" are passed on to
+    collect_abstracts
+
+    If "writer" (a bulk_writer.BulkWriter) is given along with "output_path",
+    steps (4) and (5) are replaced by stream_awards: the downloaded CSV is
+    read row by row and written straight to the database while the abstracts
+    are fetched, and the number of rows written is returned instead.
     '''
     browser.download(download_element, default_save_path, output_path,
                         is_simple = is_simple, ext = ext)
 
     award_links = award_links_from_search(browser, verbose = verbose)
     # Close the JS_browser, which is no longer needed.
-    browser.cleanup()
-    collect_abstracts(award_links)
+    if release_browser:
+        release_browser(browser)
+    else:
+        browser.cleanup()
+    if writer and output_path:
+        return stream_awards(output_path, award_links, writer,
+                                workers = abstract_workers,
+                                rate_limit = rate_limit, cache = cache,
+                                check_count = check_count, verbose = verbose)
+    collect_abstracts(award_links, workers = abstract_workers,
+                        rate_limit = rate_limit, cache = cache)
+    return award_links
 
-    if not output_path:
-        print("\nDidn't relocate downloaded file to known location, unable to "
-                "add abstract data to it. Returning dictionary mapping "
-                "award number : abstract.\n")
-        return award_links
 
+def merge_abstracts(csv_path, abstracts, check_count = False,
+    verbose = False):
+    '''
+    Reads the TAGGS export at "csv_path" into a pandas DataFrame and adds
+    the abstracts in "abstracts" (the Award Number : Abstract dictionary
+    returned by process_results). Rows whose award number has no abstract
+    are left out. "check_count" is as for process_results.
+
+    Returns the merged DataFrame, ready for store_awards.
+    '''
     abstracts_to_df = {}
-    abstracts_to_df['Award Number'] = [key for key in award_links]
-    abstracts_to_df['Abstract'] = [text for text in award_links.values()]
+    abstracts_to_df['Award Number'] = [key for key in abstracts]
+    abstracts_to_df['Abstract'] = [text for text in abstracts.values()]
     abstracts = pd.DataFrame(abstracts_to_df)
 
-    grants = pd.read_csv(output_path, encoding ='latin1')
+    grants = pd.read_csv(csv_path, encoding ='latin1')
     if check_count and verbose and len(grants.index) == 10000:
         # Print a warning if the number of results exceeds 10,000, the maximum
         # number or results which can be downloaded. This is fine if we are 
@@ -97,9 +159,12 @@ def award_links_from_search(browser, base_url = "https://taggs.hhs.gov",
     multiple_pages = False  
     # Get links from Page 1.
     award_links = award_links_from_page(browser, base_url, verbose)
+    page_award_links = award_links
     # Check if "next page" button is avaialable
     while browser.element_exists(next_page_img):
         multiple_pages = True
+        previous_source = browser.source
+        previous_award_links = page_award_links
         browser.wait_for_clickable(next_page_button)
         # This is clearly a hack, for which I am sorry, but somehow despite
         # the preceding line I continue to get errors saying this element
@@ -113,6 +178,13 @@ def award_links_from_search(browser, base_url = "https://taggs.hhs.gov",
         # Wait while the next page loads.
         browser.wait_for_page_to_load()
         page_award_links = award_links_from_page(browser, base_url, verbose)
+        # If clicking "next page" didn't bring up a different page (e.g. the
+        # pager didn't respond), stop rather than clicking it forever.
+        if (browser.source == previous_source or
+            set(page_award_links) == set(previous_award_links)):
+            print("\n WARNING: Next page of search results did not load; "
+                    "stopping with {} award links.".format(len(award_links)))
+            break
         # Collapse the two dictionaries, preferring entries from the 
         # second - though it shouldn't matter for our usage.
         award_links.update(page_award_links)
@@ -163,84 +235,325 @@ def award_links_from_page(browser, base_url, verbose = False):
     return award_links_on_page
 
 
-def collect_abstracts(award_links):
+class RateLimiter:
+
+    def __init__(self, rate):
+        '''
+        Spaces out calls to "wait" from any number of threads so that they
+        return at most "rate" times per second.
+        '''
+        self._interval = 1.0 / rate
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def wait(self):
+        '''
+        Block until the next request is allowed to go out.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def make_session(pool_size = ABSTRACT_WORKERS):
+    '''
+    Returns a requests Session that keeps up to "pool_size" connections to
+    each host alive, so that concurrent Award Detail requests reuse them
+    rather than opening a new connection each time.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = pool_size,
+                            pool_maxsize = pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def extract_abstract(detail_html):
+    '''
+    Pulls the abstract out of the HTML of an Award Detail page. Only the
+    abstract panel is read, using lxml rather than building a BeautifulSoup
+    tree for the whole page. Returns None if the page has no abstract panel.
+    '''
+    tree = lxml_html.fromstring(detail_html)
+    panel = tree.get_element_by_id("AbstractRoundPanel_CRC", None)
+    if panel is None:
+        return None
+    text = panel.text_content()
+    return text.replace("DESCRIPTION (provided by applicant):", "").strip()
+
+
+def fetch_abstract(session, link, rate_limiter = None,
+    retries = ABSTRACT_RETRIES, backoff = 1.0):
+    '''
+    Fetches the Award Detail page at "link" with "session" and returns its
+    abstract. Connection errors, rate limiting (HTTP 429) and server errors
+    are retried up to "retries" times, waiting backoff, 2 * backoff, 4 *
+    backoff... seconds in between. Returns None if every attempt fails, or
+    straight away on any other client error (e.g. a dead link's 404), which
+    retrying won't fix.
+    '''
+    for attempt in range(retries + 1):
+        if rate_limiter:
+            rate_limiter.wait()
+        try:
+            response = session.get(link, timeout = 60)
+        except requests.RequestException as e:
+            error = e
+        else:
+            if response.status_code < 400:
+                return extract_abstract(response.content)
+            error = "HTTP {}".format(response.status_code)
+            if response.status_code != 429 and response.status_code < 500:
+                break
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    print("\n had difficulty fetching abstract ({}): \n\t{}".format(error,
+            link))
+    return None
+
+
+def collect_abstracts(award_links, workers = ABSTRACT_WORKERS,
+    rate_limit = ABSTRACT_RATE_LIMIT, retries = ABSTRACT_RETRIES,
+    cache = None):
     '''
     Iterates over the Award Number: Award Detail Link dictionary and replaces
     Award Detail links with the abstracts appearing on the linked page.
+
+    Pages are fetched "workers" at a time over a shared pool of keep-alive
+    connections, sending at most "rate_limit" requests per second (None for
+    no limit), with "retries" retries of failed requests (see
+    fetch_abstract).
+
+    If "cache" (an abstract_cache.AbstractCache) is given, abstracts already
+    in it are used without fetching the page, and newly fetched ones are
+    added to it.
     '''
-    for award_number in award_links:
-        detail_html = requests.get(award_links[award_number]).content
-        detail_soup = bs4.BeautifulSoup(detail_html, "lxml")
-        text = detail_soup.find("div", id="AbstractRoundPanel_CRC").text
-        text = text.replace("DESCRIPTION (provided by applicant):", "").strip()
-        award_links[award_number] = text
+    to_fetch = dict(award_links)
+    if cache:
+        cached = cache.get_many(award_links)
+        award_links.update(cached)
+        for award_number in cached:
+            del to_fetch[award_number]
+    session = make_session(workers)
+    rate_limiter = None
+    if rate_limit:
+        rate_limiter = RateLimiter(rate_limit)
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = {award_number: executor.submit(fetch_abstract, session,
+                                                    link, rate_limiter,
+                                                    retries)
+                    for (award_number, link) in to_fetch.items()}
+        for award_number in futures:
+            award_links[award_number] = futures[award_number].result()
+    session.close()
+    if cache:
+        cache.put_many({award_number: award_links[award_number]
+                        for award_number in to_fetch})
     return None
 
 
+def stream_awards(csv_path, award_links, writer, workers = ABSTRACT_WORKERS,
+    rate_limit = ABSTRACT_RATE_LIMIT, retries = ABSTRACT_RETRIES,
+    cache = None, window = STREAM_WINDOW, check_count = False,
+    verbose = False):
+    '''
+    Streaming alternative to merge_abstracts, used for the temporary
+    database: reads the CSV at "csv_path" one row at a time, attaches the
+    abstract of the row's award and queues the row with "writer" (a
+    bulk_writer.BulkWriter), without loading the whole export into memory.
+
+    "award_links" is the Award Number : Award Detail link dictionary from
+    award_links_from_search. As with the merge, rows whose award number has
+    no link are left out. Abstracts are taken from "cache" when possible;
+    otherwise the Award Detail
+    page is fetched in the background as soon as the row is read (see
+    collect_abstracts for "workers", "rate_limit" and "retries"). Up to
+    "window" rows are held while their abstracts arrive, and rows are
+    written in the order of the file, so they reach the database long before
+    the last abstract is fetched.
+
+    The rows are committed at the end. "check_count" is as for
+    process_results.
+
+    Returns the number of rows written.
+    '''
+    cached = {}
+    if cache:
+        cached = cache.get_many(award_links)
+    session = make_session(workers)
+    rate_limiter = None
+    if rate_limit:
+        rate_limiter = RateLimiter(rate_limit)
+    # Award number : [future, number of rows in the window waiting on it],
+    # so renewals read close together share a single fetch. Abstracts
+    # fetched since the last write to the cache are kept in "fetched".
+    in_flight = {}
+    pending = deque()
+    fetched = {}
+    row_count = 0
+    csv_row_count = 0
+
+    def write_next():
+        row, award_number, waiting = pending.popleft()
+        if waiting:
+            entry = in_flight[award_number]
+            row['Abstract'] = entry[0].result()
+            entry[1] -= 1
+            if not entry[1]:
+                del in_flight[award_number]
+                fetched[award_number] = row['Abstract']
+        writer.add_rows(get_TAGG_award_rows(row))
+        if len(fetched) >= 500:
+            if cache:
+                cache.put_many(fetched)
+            fetched.clear()
+
+    with ThreadPoolExecutor(max_workers = workers) as executor, \
+        open(csv_path, newline = "", encoding = "latin1") as f:
+        for row in csv.DictReader(f):
+            csv_row_count += 1
+            award_number = row['Award Number']
+            if award_number not in award_links:
+                continue
+            # Treat empty fields as missing, like pandas does.
+            row = {key: (value if value != "" else None)
+                    for (key, value) in row.items()}
+            waiting = False
+            if award_number in cached:
+                row['Abstract'] = cached[award_number]
+            elif award_number in fetched:
+                row['Abstract'] = fetched[award_number]
+            else:
+                waiting = True
+                if award_number not in in_flight:
+                    in_flight[award_number] = [executor.submit(
+                        fetch_abstract, session, award_links[award_number],
+                        rate_limiter, retries), 0]
+                in_flight[award_number][1] += 1
+            pending.append((row, award_number, waiting))
+            row_count += 1
+            if len(pending) > window:
+                write_next()
+        while pending:
+            write_next()
+    session.close()
+    writer.flush()
+    if cache:
+        cache.put_many(fetched)
+    # Count every exported row, including those without an Award Detail
+    # link, against the export limit.
+    if check_count and verbose and csv_row_count == 10000:
+        print("WARNING: Returned > 10,000 results for this search.")
+    return row_count
+
+
 def download_awards(years, download_path, default_save_path, output_path,
     start_page, download_element, output_files, name = None, temporary = False,
-    states = [], usa = True, keywords = "", agency = [], verbose = False):
+    states = [], usa = True, keywords = "", agency = [], verbose = False,
+    cache = None, writer = None, use_http = False, pool = None,
+    headless = False):
     '''
     For a given state abbreviation in "name", download the TAGGS data we need
     to set up the database corresponding to that state. If "name" == "INTL",
-    download data for grants awarded outside the US instead.
+    download data for grants awarded outside the US instead. "cache" is an
+    optional abstract_cache.AbstractCache to take known abstracts from. With
+    a "writer", the results are streamed into its database (see
+    process_results) and the number of rows written is returned instead.
+    With use_http = True the search is made with plain HTTP requests
+    (experimental; see taggs_http.py) rather than in a browser. Otherwise,
+    if "pool" (a browser_pool.BrowserPool) is given, the browser is taken
+    from it and given back once the search results have been read, and
+    otherwise a new browser is started, running headless if "headless".
+    Without a "writer", a permanent search returns the Award Number :
+    Abstract dictionary of the exported awards (see process_results).
 
     Returns the path of the file to which downloaded data was written.
     '''
     output = output_path.format(name)
-    browser = JS_browser(download_path, invisible = False, verbose = verbose)
-    browser.go_to(start_page)
+    release_browser = None
+    if use_http:
+        browser = TAGGS_client(download_path, verbose = verbose)
+    elif pool:
+        browser = pool.acquire(download_path)
+        # Keep track of whether process_results has given the browser back
+        # yet, so that it can be retired if the search fails before then.
+        released = []
+        def release_to_pool(browser):
+            released.append(browser)
+            pool.release(browser)
+        release_browser = release_to_pool
+    else:
+        browser = JS_browser(download_path, invisible = False,
+                                verbose = verbose, headless = headless)
+    try:
+        browser.go_to(start_page)
     
-    # "temporary" is a little superfluous since "name" is only used when 
-    # "temporary" == False. However, I think including it makes this control
-    # flow much clearer; hopefully that's deemed acceptable/good.
-    if not temporary:
-        if name != "INTL":
-            # Detailed further in populate_TAGG_search.py, "search" function
-            # performs a search within the JS_browser object, navigating the
-            # browser to Page 1 of the results associated with the search as
-            # constrained by inputs to "search".
-            search(browser, years = years, states = [name], intl = False)
-        else:
-            search(browser, years = years, usa = False)
+        # "temporary" is a little superfluous since "name" is only used when
+        # "temporary" == False. However, I think including it makes this
+        # control flow much clearer; hopefully that's deemed acceptable/good.
+        if not temporary:
+            if name != "INTL":
+                # Detailed further in populate_TAGG_search.py, "search"
+                # function performs a search within the JS_browser object,
+                # navigating the browser to Page 1 of the results associated
+                # with the search as constrained by inputs to "search".
+                search(browser, years = years, states = [name], intl = False)
+            else:
+                search(browser, years = years, usa = False)
         
-        award_df = process_results(browser, default_save_path, output,
-                                    download_element, check_count = True,
-                                    verbose = verbose)
-        if verbose:
-            print('Downloaded and stored files for grants in {}'.format(name))
-        output_files.append(output)
-        return award_df
+            award_df = process_results(browser, default_save_path, output,
+                                        download_element, check_count = True,
+                                        verbose = verbose, cache = cache,
+                                        writer = writer,
+                                        release_browser = release_browser)
+            if verbose:
+                print('Downloaded and stored files for grants in {}'.format(
+                        name))
+            output_files.append(output)
+            return award_df
     
-    else:
-        award_count_elem = ('//div[.//text()="Distinct Award Count: "]/'
-                            'following-sibling::div')
-
-        if usa:
-            search(browser, years = years, states = states, intl = False,
-                keywords = keywords, agency = agency)
         else:
-            search(browser, years = years, states = [], usa = False,
-                keywords = keywords, agency = agency)
-        # I realize it's not quite ideal to call a hidden method like this,
-        # but the code required to get the number of search results in the TAGG
-        # data is pretty specific and thus it doesn't really seem appropriate
-        # to make a method within the JS_browser class specifically for that
-        # purpose. 
-        award_count = browser._find(award_count_elem).text
-        award_df = process_results(browser, default_save_path, output,
-                                    download_element, verbose = verbose)
-        return award_df, award_count
+            award_count_elem = ('//div[.//text()="Distinct Award Count: "]/'
+                                'following-sibling::div')
+
+            if usa:
+                search(browser, years = years, states = states, intl = False,
+                    keywords = keywords, agency = agency)
+            else:
+                search(browser, years = years, states = [], usa = False,
+                    keywords = keywords, agency = agency)
+            # I realize it's not quite ideal to call a hidden method like
+            # this, but the code required to get the number of search results
+            # in the TAGG data is pretty specific and thus it doesn't really
+            # seem appropriate to make a method within the JS_browser class
+            # specifically for that purpose.
+            award_count = browser._find(award_count_elem).text
+            award_df = process_results(browser, default_save_path, output,
+                                        download_element, verbose = verbose,
+                                        cache = cache, writer = writer,
+                                        release_browser = release_browser)
+            return award_df, award_count
+    except BaseException:
+        if pool and not use_http and not released:
+            pool.release(browser, healthy = False)
+        raise
 
 
 
-def add_TAGG_award(row, c):
+def get_TAGG_award_rows(row):
     '''
     !!! Mostly not my work. I changed a few things, like parametrization,
     !!! because I needed to be able to input 'Null' values. - VS
 
     Take in a row from a pandas DataFrame which corresponds to an award, and
-    inserts the data for this award into a SQL database for all TAGGS.
+    returns the rows to insert into each table of a SQL database for all
+    TAGGS, as a dictionary mapping table name : list of rows (ordered as in
+    bulk_writer.TAGG_TABLE_COLUMNS).
 
     "row" should have the following columns:
         'OPDIV', 'Recipient Name', 'Recipient Address' 'Recipient City',
@@ -249,8 +562,6 @@ def add_TAGG_award(row, c):
         'CFDA Program Name', 'Principal Investigator', 'Sum of Actions ',
         'Abstract'
 
-    "c" should be a cursor for the database to populate
-
     This is heavily based on MS's function add_award_to_db in nsf_scrape.py to
     make this database easily added to that one and vice versa.
     '''
@@ -264,11 +575,8 @@ def add_TAGG_award(row, c):
     # grant was awarded is more important than the starting fiscal year.
     start_date = row['Action Issue Date']
     end_date = None # Information not available from TAGGS data
-    c.execute('''INSERT OR REPLACE INTO awards (award_id, agency, title,
-                abstract, amount, start_date, end_date)
-                VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                (award_id, agency, title, abstract, amount, start_date,
-                    end_date))
+    rows = {'awards': [(award_id, agency, title, abstract, amount, start_date,
+                        end_date)]}
 
     name = row['Principal Investigator']
     if isinstance(name, str):
@@ -286,9 +594,7 @@ def add_TAGG_award(row, c):
         last_name = name
     email = None
     role = None
-    c.execute('''INSERT OR REPLACE INTO investigators (award_id, last_name,
-                first_name, role, email) VALUES (?, ?, ?, ?, ?)''',
-                (award_id, last_name, first_name, role, email))
+    rows['investigators'] = [(award_id, last_name, first_name, role, email)]
 
     name = row['Recipient Name']
     address = row['Recipient Address']
@@ -298,28 +604,75 @@ def add_TAGG_award(row, c):
     country = row['Recipient Country']
     if country == "United States of America":
         country = "United States" # Enforce NSF's shorter listing for USA
-    c.execute('''INSERT OR REPLACE INTO institutions (award_id, name, address,
-                 city, state, zipcode, country)
-                 VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                 (award_id, name, address, city, state_code, zipcode, country))
+    rows['institutions'] = [(award_id, name, address, city, state_code,
+                             zipcode, country)]
 
     organization_code = None
     directorate = None
     # Nearest approximation of appropriate data for this field.
     division = row['CFDA Program Name']
-    c.execute('''INSERT OR REPLACE INTO organizations (award_id,
-                 organization_code, directorate, division)
-                 VALUES (?, ?, ?, ?)''',
-                 (award_id, organization_code, directorate, division))
+    rows['organizations'] = [(award_id, organization_code, directorate,
+                              division)]
+    return rows
+
+
+def get_TAGG_frame_rows(award_df):
+    '''
+    Column-wise version of get_TAGG_award_rows for a whole pandas DataFrame
+    of awards (with the same columns): the amount parsing, splitting of PI
+    names and country cleanup are done on entire columns at once, and the
+    rows for each table are zipped together from the columns. Missing values
+    become None. Used for the permanent databases (see store_awards), while
+    get_TAGG_award_rows serves rows streamed into the temporary database.
+    '''
+    df = award_df.astype(object).where(award_df.notnull(), None)
+    award_id = df['Award Number'].tolist()
+    amount = (award_df['Sum of Actions '].str.strip()
+                .str.replace("$", "", regex = False)
+                .str.replace(",", "", regex = False)
+                .astype("int64").tolist())
+    no_date = [None] * len(award_id) # End date not available from TAGGS data
+    rows = {'awards': list(zip(award_id, df['OPDIV'], df['Award Title'],
+                                df['Abstract'], amount,
+                                df['Action Issue Date'], no_date))}
+
+    # As in get_TAGG_award_rows, names of a single word (or missing names) go
+    # into the last name field only.
+    name = df['Principal Investigator']
+    name_parsed = name.str.split()
+    multiple = name_parsed.str.len().fillna(0) > 1
+    first_name = name_parsed.str[:-1].str.join(" ").where(multiple, None)
+    last_name = name_parsed.str[-1].where(multiple, name)
+    rows['investigators'] = list(zip(award_id, last_name.tolist(),
+                                        first_name.tolist(), no_date,
+                                        no_date))
+
+    # Enforce NSF's shorter listing for USA
+    country = df['Recipient Country'].replace("United States of America",
+                                                "United States")
+    rows['institutions'] = list(zip(award_id, df['Recipient Name'],
+                                    df['Recipient Address'],
+                                    df['Recipient City'],
+                                    df['Recipient State'],
+                                    df['Recipient ZIP Code'],
+                                    country.tolist()))
 
+    # Nearest approximation of appropriate data for the division.
+    rows['organizations'] = list(zip(award_id, no_date, no_date,
+                                        df['CFDA Program Name']))
+    return rows
 
-def store_awards(award_df, cursor, verbose = False):
+
+def store_awards(award_df, writer, verbose = False):
     '''
-    Simple helper function that implements the row-wise process of taking a
-    dataframe of award data and placing it into the database structure.
+    Simple helper function that takes a dataframe of award data (e.g. from
+    merge_abstracts) and places it into the database structure, converting
+    it column-wise (see get_TAGG_frame_rows). Rows are queued in one call, so
+    they are committed together with anything already queued, through
+    "writer" (a bulk_writer.BulkWriter).
     '''
-    for index, row in award_df.iterrows():
-        add_TAGG_award(row, cursor)
+    writer.add_rows(get_TAGG_frame_rows(award_df))
+    writer.flush()
     if verbose:
         print('\tSuccessfully added this data to SQL database.')
 
@@ -378,14 +731,269 @@ def connect_db(db_filename):
     return (conn, c)
 
 
+def open_abstract_cache():
+    '''
+    Opens the abstract cache shared by all TAGGS collections (permanent and
+    temporary) on this machine.
+    '''
+    if is_VM():
+        cache_name = "/home/student/cs122_MVR/data/abstract_cache.db"
+    else:
+        cache_name = "/Users/Vishok/Desktop/122/Assignments/Project/data/abstract_cache.db"
+    return AbstractCache(cache_name)
+
+
+# Tables written by a permanent collection: the award tables plus the job
+# ledger (see init_job_ledger).
+JOB_TABLE_COLUMNS = dict(TAGG_TABLE_COLUMNS)
+JOB_TABLE_COLUMNS['collection_jobs'] = ['year', 'state', 'status',
+                                        'row_count', 'csv_path', 'attempts',
+                                        'updated_at']
+
+
+def get_collection_paths(year):
+    '''
+    Returns the database file name and the download folder used when
+    collecting the permanent database for a single year.
+    '''
+    if is_VM():
+        db_name = "/home/student/cs122_MVR/taggs{}.db"
+        download_path = "/home/student/cs122_MVR/data/taggs{}/"
+    else:
+        db_name = "/Users/Vishok/Desktop/122/Assignments/Project/taggs{}.db"
+        download_path = "/Users/Vishok/Desktop/122/Assignments/Project/data/taggs{}/"
+    return db_name.format("_" + year), download_path.format("/" + year)
+
+
+# Abstract cache and browser pool of the current collection worker (see
+# init_collection_worker).
+_worker_cache = None
+_worker_pool = None
+
+def init_collection_worker(headless = False):
+    '''
+    Sets up a process that runs collect_state jobs. Each worker process
+    opens its own connection to the abstract cache, and keeps its browser
+    (headless if "headless") running from one job to the next in a
+    single-browser pool, which is shut down when the process exits.
+    '''
+    global _worker_cache, _worker_pool
+    _worker_cache = open_abstract_cache()
+    _worker_pool = BrowserPool(size = 1, invisible = False,
+                                headless = headless)
+    Finalize(None, _worker_pool.close, exitpriority = 10)
+
+
+def init_job_ledger(cursor):
+    '''
+    Adds the job ledger to a permanent TAGGS database if it is not there
+    yet. The ledger has a row for each (year, state) job of the collection
+    with its status ("done" or "failed"), the number of rows stored, the
+    CSV file it was built from, the number of attempts so far and when it
+    last changed. A "done" row is committed together with the state's
+    awards, so a restarted collection can skip every state it records.
+    '''
+    cursor.execute('''CREATE TABLE IF NOT EXISTS collection_jobs
+                      (year text,
+                       state text,
+                       status text,
+                       row_count int,
+                       csv_path text,
+                       attempts int,
+                       updated_at text,
+                       constraint pk_collection_jobs
+                       primary key (year, state));''')
+
+
+def collect_state(job):
+    '''
+    Runs a single (year, state, verbose, use_http) job of a permanent
+    collection in its own browser (or HTTP session, with use_http = True; see
+    download_awards): searches TAGGS for the state's grants in that year (or
+    for grants outside the US if state is "INTL") and collects their
+    abstracts. Each job downloads into its own folder so that browsers
+    running at the same time don't pick up each other's exports.
+
+    Returns (year, state, abstracts, output_path, error), where abstracts is
+    the Award Number : Abstract dictionary of the exported awards, leaving
+    reading the CSV at output_path into the database to the caller (see
+    merge_abstracts). If the job fails, abstracts is None and error describes
+    what went wrong.
+    '''
+    (year, state, verbose, use_http) = job
+    db_name, download_path = get_collection_paths(year)
+    state_path = download_path + state + "/"
+    if not os.path.exists(state_path):
+        os.makedirs(state_path)
+    output_path = download_path + "TAGGS_{}.csv"
+    default_save_path = state_path + "TAGGS Export "
+    output_files = []
+    try:
+        abstracts = download_awards([year], state_path, default_save_path,
+                                    output_path, START_PAGE,
+                                    DOWNLOAD_ELEMENT, output_files,
+                                    name = state, verbose = verbose,
+                                    cache = _worker_cache,
+                                    use_http = use_http,
+                                    pool = _worker_pool)
+    except Exception as e:
+        return year, state, None, output_path.format(state), repr(e)
+    return year, state, abstracts, output_path.format(state), None
+
+
+def collect_years(years, workers = 1, verbose = True, max_attempts = 3,
+    backoff = 60, use_http = False, headless = False):
+    '''
+    Collects the permanent databases (taggs_<year>.db) for every year in
+    "years" as one job. Each (year, state) pair, plus (year, "INTL"), is a
+    separate job; with workers > 1 the jobs are run on a pool of that many
+    processes, each driving its own browser. Only this process writes to the
+    databases, one state at a time as the jobs finish, merging each state's
+    CSV export with the abstracts its job collected (see merge_abstracts)
+    and storing it column-wise (see store_awards).
+
+    Progress is recorded in each database's job ledger (see
+    init_job_ledger): jobs already done are skipped, so an interrupted
+    collection can simply be started again. Failed jobs are retried up to
+    "max_attempts" times in this run, waiting "backoff" seconds before the
+    first retry and twice as long before each one after that. "use_http" is
+    passed on to download_awards, and with headless = True the browsers run
+    in Chrome's headless mode. The worker processes and their browsers are
+    shut down however the collection ends; if it is interrupted, rows of a
+    state not yet committed are rolled back.
+
+    Returns the list of downloaded CSV files.
+    '''
+    years = [str(year) for year in years]
+    connections = {}
+    writers = {}
+    jobs = []
+    attempts = {}
+    output_files = []
+    for year in years:
+        db_name, download_path = get_collection_paths(year)
+        if not os.path.exists(download_path):
+            os.makedirs(download_path)
+        connections[year], cursor = connect_db(db_name)
+        init_job_ledger(cursor)
+        ledger = cursor.execute('''SELECT state, status, csv_path, attempts
+                                   FROM collection_jobs
+                                   WHERE year = ?;''', (year,)).fetchall()
+        ledger = {state: (status, csv_path, tries)
+                    for (state, status, csv_path, tries) in ledger}
+        for state in TAGGS_STATES + ["INTL"]:
+            (status, csv_path, tries) = ledger.get(state, (None, None, 0))
+            attempts[(year, state)] = tries
+            if status == "done":
+                output_files.append(csv_path)
+            else:
+                jobs.append((year, state, verbose, use_http))
+        writers[year] = BulkWriter(connections[year], JOB_TABLE_COLUMNS)
+    total = len(jobs)
+    if verbose:
+        print("{} of {} jobs already done.".format(
+                len(years) * (len(TAGGS_STATES) + 1) - total,
+                len(years) * (len(TAGGS_STATES) + 1)))
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_collection_worker,
+                                    (headless,))
+        run_jobs = pool.imap_unordered
+    else:
+        pool = None
+        init_collection_worker(headless)
+        run_jobs = map
+    finished = False
+    try:
+        done = 0
+        for attempt in range(max_attempts):
+            if not jobs:
+                break
+            if attempt > 0:
+                if verbose:
+                    print("Retrying {} failed jobs in {} seconds.".format(
+                            len(jobs), backoff * 2 ** (attempt - 1)))
+                time.sleep(backoff * 2 ** (attempt - 1))
+            failed = []
+            for (year, state, abstracts, csv_path, error) in run_jobs(
+                    collect_state, jobs):
+                attempts[(year, state)] += 1
+                now = time.strftime("%Y-%m-%d %H:%M:%S")
+                writer = writers[year]
+                if not error:
+                    try:
+                        award_df = merge_abstracts(csv_path, abstracts,
+                                                    check_count = True,
+                                                    verbose = verbose)
+                        # The ledger row is queued ahead of the state's
+                        # awards, which store_awards adds in a single call,
+                        # so both are committed in the same transaction;
+                        # committing each state also saves the database in
+                        # case of unexpected errors, e.g., web connection
+                        # loss.
+                        writer.add("collection_jobs", (year, state, "done",
+                                    len(award_df.index), csv_path,
+                                    attempts[(year, state)], now))
+                        store_awards(award_df, writer, verbose)
+                    except Exception as e:
+                        # Don't let this state's ledger row be committed
+                        # with the next state's awards.
+                        writer.discard()
+                        error = repr(e)
+                if error:
+                    failed.append((year, state, verbose, use_http))
+                    writer.add("collection_jobs", (year, state, "failed",
+                                None, csv_path, attempts[(year, state)],
+                                now))
+                    writer.flush()
+                    if verbose:
+                        print("Failed {} {}: {}".format(year, state, error))
+                    continue
+                output_files.append(csv_path)
+                done += 1
+                if verbose:
+                    print("Stored {} {} ({} of {} jobs done, {} "
+                            "failed)".format(year, state, done, total,
+                            len(failed)))
+            jobs = failed
+        finished = True
+    finally:
+        # Shut the browsers down however the collection ends. After an error
+        # (including KeyboardInterrupt) the workers are stopped at once and
+        # any rows of a state that was being stored are rolled back.
+        if pool:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        else:
+            _worker_pool.close()
+            _worker_cache.close()
+        for year in years:
+            if not finished:
+                writers[year].discard()
+                connections[year].rollback()
+            writers[year].close()
+            connections[year].close()  # Close database
+    if jobs:
+        print("\nWARNING: {} jobs still failed after {} attempts; run the "
+                "collection again to retry them.".format(len(jobs),
+                max_attempts))
+    return output_files
+
+
 def setup_database(years = [], verbose = True, temporary = False, usa = True,
-    keywords = "", agency = []):
+    keywords = "", agency = [], workers = 1, use_http = False,
+    headless = False):
     '''
     Sets up database of CDC and NIH grants. Runs if this script
     (collect_TAGG.py) is executed from the terminal. In this case "years"
-    should have a single entry. Since the user isn't really going to interact
-    with this function it's not so important to setup error messages that
-    express this constraint and throw errors if it is violated.
+    should be a single year or a list of years, each of which gets its own
+    database, and "workers" browsers are run at once (see collect_years).
+    Since the user isn't really going to interact with this function it's
+    not so important to setup error messages that express this constraint
+    and throw errors if it is violated.
 
     When temporary = True, the user has the option to preserve downloaded
     files. Other the data is input into the database, but associated downloads
@@ -395,62 +1003,24 @@ def setup_database(years = [], verbose = True, temporary = False, usa = True,
     temporary = TRUE and specifying values for "usa" an "keywords", which is
     helpful when we want to make a smaller search to input into a cached
     results database.
+
+    With use_http = True, searches are made with plain HTTP requests instead
+    of in a browser (experimental; see taggs_http.py). With headless = True, the browsers
+    run in Chrome's headless mode; temporary searches take theirs from the
+    shared pool (see browser_pool.get_pool), so this only applies if the
+    pool hasn't been started yet in this process.
     '''
-    start_page = "https://taggs.hhs.gov/SearchAdv"
-    download_element = '//*[@id="btnExportToCSVSearchAdvExport_AdvSearchFilter"]'
     output_files = []
-    states = ['AL', 'AK', 'AS', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC', 'FM', 
-                'FL', 'GA', 'GU', 'HI', 'ID', 'IL', 'IN', 'IA', 'JQ', 'KS',
-                'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT',
-                'MQ', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'MP',
-                'BQ', 'OH', 'OK', 'OR', 'PA', 'PR', 'MH', 'PW', 'RI', 'SC',
-                'SD', 'TN', 'TX', 'UT', 'VT', 'VI', 'VA', 'WA', 'WV', 'WI',
-                'WY', 'WQ']
     
     # For setup of databases to be stored permanently.
     if not temporary:
-        if is_VM():
-            db_name = "/home/student/cs122_MVR/taggs{}.db"
-            download_path = "/home/student/cs122_MVR/data/taggs{}/"
-        else:
-            db_name = "/Users/Vishok/Desktop/122/Assignments/Project/taggs{}.db"
-            download_path = "/Users/Vishok/Desktop/122/Assignments/Project/data/taggs{}/"
-
-        db_name = db_name.format("_" + years)
-        download_path = download_path.format("/" + years)
-        if not os.path.exists(download_path):
-            os.makedirs(download_path)
-        output_path = download_path + "TAGGS_{}.csv"
-        default_save_path = download_path + "TAGGS Export "
-
-        connection, cursor = connect_db(db_name)
-        
-        # Separately download/scrape and format data from each U.S. state.
-        for state in states:
-            award_df = download_awards(years, download_path,
-                                        default_save_path, output_path,
-                                        start_page, download_element,
-                                        output_files, name = state,
-                                        verbose = verbose)
-            store_awards(award_df, cursor, verbose)
-             # Save database in case of unexpected errors, e.g., web connection
-             # loss.
-            connection.commit()
-        # Download/scrape and format data from grants awarded outside the US.
-        # I chose not to wrap this code and the contents of the loop directly
-        # above this because although there is a little bit of repeated code,
-        # it's relatively easier to read and understand this way as opposed to
-        # the alternative of storing many of these search parameters in some
-        # secondary variable and passing that to some other function to call
-        # download_awards and store_awards.
-        award_df = download_awards(years, download_path,
-                                    default_save_path, output_path, start_page,
-                                    download_element, output_files,
-                                    name = "INTL", verbose = verbose)
-        store_awards(award_df, cursor, verbose)
-        connection.commit() # Save database
+        if isinstance(years, (str, int)):
+            years = [years]
+        output_files = collect_years(years, workers = workers,
+                                        verbose = verbose,
+                                        use_http = use_http,
+                                        headless = headless)
 
-        connection.close()  # Close database
         do_not_clean = input("\nDatabase download/construction complete. You "
                                 "now may choose to keep the CSV files used to "
                                 "create the database, or choose to remove "
@@ -481,16 +1051,24 @@ def setup_database(years = [], verbose = True, temporary = False, usa = True,
 
         # Create the temporary database if it exists, otherwise just open it.
         connection, cursor = connect_db(db_name)
+        writer = BulkWriter(connection, TAGG_TABLE_COLUMNS)
+        cache = open_abstract_cache()
 
-        award_df, count = download_awards(years, download_path,
+        # The search results are streamed into the database as the abstracts
+        # come in, rather than collected into a DataFrame first.
+        row_count, count = download_awards(years, download_path,
                                             default_save_path, output_path,
-                                            start_page, download_element,
+                                            START_PAGE, DOWNLOAD_ELEMENT,
                                             output_files, temporary = True,
-                                            states = states, usa = usa,
+                                            states = TAGGS_STATES, usa = usa,
                                             keywords = keywords,
-                                            agency = agency, verbose = False)
-        store_awards(award_df, cursor, verbose)
-        connection.commit() # Save database
+                                            agency = agency, verbose = False,
+                                            cache = cache, writer = writer,
+                                            use_http = use_http,
+                                            pool = get_pool(
+                                                headless = headless))
+        writer.close()
+        cache.close()
         connection.close()  # Close database
         # Output_files should have length 1 when temporary = True, since only
         # a single search is performed.
@@ -500,18 +1078,40 @@ def setup_database(years = [], verbose = True, temporary = False, usa = True,
 
 
 if __name__=="__main__":
-    num_args = len(sys.argv)
-
-    usage = ("usage: python3 " + sys.argv[0] + " <year>" +
+    usage = ("usage: python3 " + sys.argv[0] + " <year> [<year> ...] "
+            "[--workers N] [--http] [--headless]" +
             "\n Populates initial database of CDC and NIH grants. Year input "
-            " must be a number between 1991 and 2017.")
+            " must be a number between 1991 and 2017. With several years, "
+            "\n each gets its own database; --workers N runs N browsers at "
+            "once. \n --http (experimental, not yet verified against the live "
+            "site) searches TAGGS with plain HTTP requests instead of a "
+            "browser; \n --headless runs the browsers in Chrome's "
+            "headless mode.")
+
+    args = sys.argv[1:]
+    workers = 1
+    use_http = '--http' in args
+    if use_http:
+        args.remove('--http')
+    headless = '--headless' in args
+    if headless:
+        args.remove('--headless')
+    if '--workers' in args:
+        idx = args.index('--workers')
+        try:
+            workers = int(args[idx + 1])
+        except (IndexError, ValueError):
+            print(usage)
+            sys.exit(0)
+        del args[idx:idx + 2]
 
-    if num_args == 2:
+    if len(args) >= 1:
         try:
-            validate_input = (int(sys.argv[1]))
+            validate_input = [int(year) for year in args]
             # We need to check if this input is a valid year, but actually
             # want to use it as a string.
-            setup_database(sys.argv[1])
+            setup_database(args, workers = workers, use_http = use_http,
+                            headless = headless)
         except ValueError:
             print(usage)
             sys.exit(0)
@@ -7,6 +7,11 @@ import sys
 import os
 import sqlite3
 import re
+import json
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from bulk_writer import BulkWriter
+from ngram_engine import ngrams, count_ngrams, get_stopword_set
 #import nltk # <-- used for an older version
 #from nltk.corpus import stopwords # <-- used for an older version
 
@@ -17,63 +22,390 @@ INDEX_IGNORE = set(['a', 'also', 'an', 'and', 'are', 'as', 'at', 'be',
                     'such', 'that', 'the', 'their', 'then', 'this', 'through', 'to',
                     'we', 'were', 'which', 'will', 'with', 'yet'])
 
+# Full-text index of award titles and abstracts (see add_and_populate_fts_table)
+FTS_TABLE = 'awards_fts'
 
-def add_and_populate_index_table(db_filename):
+
+def strip_stopwords(text):
+    '''
+    Returns text with the words in INDEX_IGNORE removed (in any case), so that
+    they are left out of the full-text index and out of queries against it.
+    '''
+    if not text:
+        return ''
+    words = re.findall(r'\w+', text)
+    return ' '.join([w for w in words if w.lower() not in INDEX_IGNORE])
+
+
+def add_and_populate_fts_table(db_filename, chunk_size=10000):
+    '''
+    Takes in a SQL database filename and builds an SQLite FTS5 full-text index
+    (table awards_fts) over the award titles and abstracts, replacing any
+    previous one. Words are stemmed (porter tokenizer) and words in
+    INDEX_IGNORE are left out. The index is contentless: it stores only the
+    index itself, and the rowid of each entry is the rowid of the award in
+    the awards table (see database_util.full_text_search).
+
+    Since rowids of the awards table can change when a database is copied or
+    vacuumed, build this index on the final database (e.g. MVR.db after
+    stitch_databases.py).
+    '''
+    conn = sqlite3.connect(db_filename)
+    c = conn.cursor()
+
+    c.execute('DROP TABLE IF EXISTS {};'.format(FTS_TABLE))
+    c.execute('''CREATE VIRTUAL TABLE {} USING fts5
+                 (title, abstract, content='',
+                  tokenize='porter unicode61');'''.format(FTS_TABLE))
+
+    read_cursor = conn.cursor()
+    read_cursor.execute('SELECT rowid, title, abstract FROM awards;')
+    count = 0
+    rows = read_cursor.fetchmany(chunk_size)
+    while rows:
+        c.executemany('''INSERT INTO {} (rowid, title, abstract)
+                         VALUES (?, ?, ?);'''.format(FTS_TABLE),
+                      [(rowid, strip_stopwords(title), strip_stopwords(abstract))
+                       for (rowid, title, abstract) in rows])
+        count += len(rows)
+        print('Indexed', count, 'Awards')
+        rows = read_cursor.fetchmany(chunk_size)
+
+    # Merge the index segments built up by the inserts for faster queries
+    c.execute('''INSERT INTO {} ({}) VALUES ('optimize');'''.format(
+              FTS_TABLE, FTS_TABLE))
+    print('COMPLETE: Full-text index has been added to ' + db_filename)
+    conn.commit() # Save database
+    conn.close() # Close database
+
+
+# Column order of the rows inserted into keyword_index (see bulk_writer.py)
+KEYWORD_INDEX_COLUMNS = {'keyword_index': ['award_id', 'keyword']}
+# Table recording the highest awards rowid already in keyword_index, so that
+# later runs can index only awards added since
+INDEX_META_TABLE = 'index_meta'
+
+
+def get_keywords(title, abstract):
+    '''
+    Returns the set of keywords indexed for an award: the distinct words of
+    its title and abstract, without punctuation or words in INDEX_IGNORE,
+    lower cased unless written in all capitals (e.g. HIV).
+    '''
+    text = (title or '') + ' ' + (abstract or '')
+    text = re.sub(r'[^\w\s]', '', text)
+
+    keywords = set()
+    for w in set(text.split()):
+        w = w.strip()
+        if w in INDEX_IGNORE:
+            continue
+        if w.isupper():
+            keywords.add(w)
+        else:
+            keywords.add(w.lower())
+    return keywords
+
+
+def get_index_watermark(c):
+    '''
+    Returns the highest awards rowid already in keyword_index (0 if no
+    index has been recorded).
+    '''
+    c.execute('''CREATE TABLE IF NOT EXISTS {}
+                 (name text,
+                  value int,
+                  constraint pk_index_meta primary key (name));'''.format(
+              INDEX_META_TABLE))
+    c.execute('''SELECT value FROM {} WHERE name = 'keyword_index'
+              ;'''.format(INDEX_META_TABLE))
+    result = c.fetchone()
+    if result:
+        return result[0]
+    return 0
+
+
+def rebuild_keyword_index(db_filename, incremental=False, chunk_size=10000):
     '''
     Takes in a SQL database filename and builds a keyword index from all words
-    in the award titles and abstacts. This index is added to the database as a
-    new table (keyword_index).
+    in the award titles and abstacts, as the keyword_index table (one row per
+    distinct keyword of each award, see get_keywords).
+
+    Awards are read chunk_size at a time and their rows written in large
+    batches; the (keyword, award_id) index used for keyword lookups is
+    created once all rows are in, which is much faster than keeping it up to
+    date row by row.
+
+    With incremental=True, only awards added since the last run (those with
+    a higher rowid, including awards replaced since) are indexed, and any old
+    keyword_index rows of those awards are removed first. Otherwise, or if no
+    earlier run has finished, the table is rebuilt from scratch.
     '''
     conn = sqlite3.connect(db_filename)
     c = conn.cursor()
 
+    # Also makes sure the index_meta table exists
+    watermark = get_index_watermark(c)
+    if not watermark:
+        # Without a watermark (no run has finished yet, or the last full
+        # rebuild was interrupted) any existing rows can't be told apart from
+        # the ones about to be written, so build the index from scratch.
+        incremental = False
+    if not incremental:
+        watermark = 0
+        c.execute('DROP INDEX IF EXISTS idx_keyword_index;')
+        c.execute('DROP TABLE IF EXISTS keyword_index;')
+        c.execute('''DELETE FROM {} WHERE name = 'keyword_index'
+                  ;'''.format(INDEX_META_TABLE))
     c.execute('''CREATE TABLE IF NOT EXISTS keyword_index
                  (award_id int,
                   keyword text,
                   constraint fk_index foreign key (award_id)
                   references awards (award_id));''')
 
-    c.execute('''SELECT award_id, title, abstract from awards;''')
-    title_list = c.fetchall()
-    print('Processing', len(title_list), 'Awards')
+    c.execute('''SELECT COUNT(*), MAX(rowid) FROM awards
+                 WHERE rowid > ?;''', [watermark])
+    (num_awards, max_rowid) = c.fetchone()
+    print('Processing', num_awards, 'Awards')
+    if not num_awards:
+        conn.commit()
+        conn.close()
+        return
+
+    if watermark:
+        # Remove the rows of re-indexed awards in a single pass over the table
+        c.execute('''DELETE FROM keyword_index WHERE award_id IN
+                     (SELECT award_id FROM awards WHERE rowid > ?);''',
+                  [watermark])
 
-    for i, (award_id, tmp_title, tmp_abstract) in enumerate(title_list):
+    writer = BulkWriter(conn, KEYWORD_INDEX_COLUMNS, batch_size=200000)
+    read_cursor = conn.cursor()
+    read_cursor.execute('''SELECT award_id, title, abstract FROM awards
+                           WHERE rowid > ? AND rowid <= ?;''',
+                        [watermark, max_rowid])
+    count = 0
+    rows = read_cursor.fetchmany(chunk_size)
+    while rows:
+        writer.add_rows({'keyword_index':
+                         [(award_id, keyword)
+                          for (award_id, title, abstract) in rows
+                          for keyword in get_keywords(title, abstract)]})
+        count += len(rows)
+        print('Indexed', count, 'of', num_awards, 'Awards')
+        rows = read_cursor.fetchmany(chunk_size)
 
-        text = tmp_title + ' ' + tmp_abstract
-        text = re.sub(r'[^\w\s]', '', text)
+    c.execute('''INSERT OR REPLACE INTO {} (name, value)
+                 VALUES ('keyword_index', ?);'''.format(INDEX_META_TABLE),
+              [max_rowid])
+    writer.close()
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_keyword_index
+                 ON keyword_index (keyword, award_id);''')
+    c.execute('ANALYZE keyword_index;')
+
+    print('COMPLETE: Index has been added to ' + db_filename)
+    conn.commit() # Save database
+    conn.close() # Close database
 
-        words = set(text.split())
-        words = [w.strip() for w in words if w.strip() not in INDEX_IGNORE]
 
-        #tokens = nltk.wordpunct_tokenize(text)
-        #words = [w for w in tokens if not w in stopwords.words('english')]
+# Per-award trigram counts (see build_trigram_tables). Trigrams are stored
+# once in trigram_vocab, as their words joined by single spaces, and
+# award_trigrams refers to them by id.
+TRIGRAM_VOCAB_TABLE = 'trigram_vocab'
+AWARD_TRIGRAMS_TABLE = 'award_trigrams'
+TRIGRAM_TABLE_COLUMNS = {
+    TRIGRAM_VOCAB_TABLE: ['trigram_id', 'trigram'],
+    AWARD_TRIGRAMS_TABLE: ['award_id', 'trigram_id', 'count'],
+    }
 
-        for w in words:
-            if w.isupper():
-                keyword = w
-            else:
-                keyword = w.lower()
-    
-            c.execute('''INSERT OR REPLACE INTO keyword_index (award_id, keyword)
-                         VALUES (?, ?);''', (award_id, keyword))
 
-    print('COMPLETE: Index has been added to ' + db_filename)
+def build_trigram_tables(db_filename, chunk_size=10000):
+    '''
+    Takes in a SQL database filename and counts the trigrams of every award's
+    title and abstract, with the same tokenizing and stopwords as
+    ngram_engine.py (so the counts match what search_database_for_trigrams
+    would find from the text itself). Adds the counts as two new tables,
+    replacing any previous ones:
+        trigram_vocab (trigram_id, trigram) : each distinct trigram once
+        award_trigrams (award_id, trigram_id, count) : times each trigram
+            appears in each award
+    With these in place database_util.search_database_for_trigrams ranks
+    trigrams with a single SQL aggregation instead of reading and tokenizing
+    the abstracts of every matching award.
+    '''
+    conn = sqlite3.connect(db_filename)
+    c = conn.cursor()
+
+    c.execute('DROP TABLE IF EXISTS {};'.format(AWARD_TRIGRAMS_TABLE))
+    c.execute('DROP TABLE IF EXISTS {};'.format(TRIGRAM_VOCAB_TABLE))
+    c.execute('''CREATE TABLE {}
+                 (trigram_id integer primary key,
+                  trigram text unique);'''.format(TRIGRAM_VOCAB_TABLE))
+    c.execute('''CREATE TABLE {}
+                 (award_id text,
+                  trigram_id int,
+                  count int,
+                  constraint fk_award_trigrams foreign key (award_id)
+                  references awards (award_id));'''.format(
+              AWARD_TRIGRAMS_TABLE))
+
+    c.execute('SELECT COUNT(*) FROM awards;')
+    num_awards = c.fetchone()[0]
+    print('Processing', num_awards, 'Awards')
+
+    stopword_set = get_stopword_set()
+    trigram_ids = {}
+    writer = BulkWriter(conn, TRIGRAM_TABLE_COLUMNS, batch_size=200000)
+    read_cursor = conn.cursor()
+    read_cursor.execute('SELECT award_id, title, abstract FROM awards;')
+    count = 0
+    rows = read_cursor.fetchmany(chunk_size)
+    while rows:
+        vocab_rows = []
+        trigram_rows = []
+        for (award_id, title, abstract) in rows:
+            counts = count_ngrams([title, abstract], 3,
+                                  stopword_set=stopword_set)
+            for (trigram, trigram_count) in counts.items():
+                trigram = ' '.join(trigram)
+                trigram_id = trigram_ids.get(trigram)
+                if trigram_id is None:
+                    trigram_id = len(trigram_ids) + 1
+                    trigram_ids[trigram] = trigram_id
+                    vocab_rows.append((trigram_id, trigram))
+                trigram_rows.append((award_id, trigram_id, trigram_count))
+        writer.add_rows({TRIGRAM_VOCAB_TABLE: vocab_rows,
+                         AWARD_TRIGRAMS_TABLE: trigram_rows})
+        count += len(rows)
+        print('Counted trigrams of', count, 'of', num_awards, 'Awards')
+        rows = read_cursor.fetchmany(chunk_size)
+    writer.close()
+
+    # Covering index: a search's rows are found by award_id and summed
+    # without reading the table itself
+    c.execute('''CREATE INDEX idx_award_trigrams
+                 ON {} (award_id, trigram_id, count);'''.format(
+              AWARD_TRIGRAMS_TABLE))
+    c.execute('ANALYZE {};'.format(AWARD_TRIGRAMS_TABLE))
+
+    print('COMPLETE: Trigram counts have been added to ' + db_filename)
     conn.commit() # Save database
     conn.close() # Close database
 
 
+# TF-IDF trigram model of a database (see build_tfidf_model), saved in the
+# directory <database>.tfidf: the award x trigram TF-IDF matrix in compressed
+# sparse row form (three .npy arrays, memory-mapped when loaded), the trigram
+# of each matrix column and the award_id of each matrix row
+TFIDF_MODEL_SUFFIX = '.tfidf'
+TFIDF_ARRAYS = ['data', 'indices', 'indptr']
+TFIDF_VOCABULARY_FILE = 'vocabulary.json'
+TFIDF_AWARD_IDS_FILE = 'award_ids.json'
+
+
+def get_tfidf_model_path(db_filename):
+    '''
+    Returns the directory holding the TF-IDF model of a database.
+    '''
+    return db_filename + TFIDF_MODEL_SUFFIX
+
+
+def build_tfidf_model(db_filename, min_df=2):
+    '''
+    Takes in a SQL database filename and fits a TF-IDF model of the trigrams
+    (tokenized as in ngram_engine.py, never spanning title and abstract) of
+    every award, one row per award. The resulting matrix, its vocabulary and
+    the award_id of each row are saved in get_tfidf_model_path(db_filename),
+    replacing any previous model, for database_util.tf_idf to rank the
+    trigrams of search results without refitting.
+
+    Trigrams found in fewer than min_df awards are left out of the
+    vocabulary, which keeps the model much smaller; they are never the
+    trigrams shared by a set of search results anyway.
+    '''
+    conn = sqlite3.connect(db_filename)
+    c = conn.cursor()
+
+    stopword_set = get_stopword_set()
+    award_ids = []
+
+    def award_documents():
+        c.execute('SELECT award_id, title, abstract FROM awards;')
+        for (award_id, title, abstract) in c:
+            award_ids.append(award_id)
+            if len(award_ids) % 10000 == 0:
+                print('Counted trigrams of', len(award_ids), 'Awards')
+            yield (title, abstract)
+
+    def award_trigrams(award):
+        return [' '.join(trigram) for text in award
+                for trigram in ngrams(text, 3, stopword_set)]
+
+    vectorizer = TfidfVectorizer(analyzer=award_trigrams, min_df=min_df,
+                                 dtype=np.float32)
+    matrix = vectorizer.fit_transform(award_documents())
+    conn.close() # Close database
+    print('Fitted TF-IDF model over', matrix.shape[0], 'Awards and',
+          matrix.shape[1], 'trigrams')
+
+    vocabulary = [None] * len(vectorizer.vocabulary_)
+    for (trigram, column) in vectorizer.vocabulary_.items():
+        vocabulary[column] = trigram
+
+    model_path = get_tfidf_model_path(db_filename)
+    if not os.path.exists(model_path):
+        os.makedirs(model_path)
+    for name in TFIDF_ARRAYS:
+        np.save(os.path.join(model_path, name + '.npy'), getattr(matrix, name))
+    with open(os.path.join(model_path, TFIDF_VOCABULARY_FILE), 'w') as f:
+        json.dump(vocabulary, f)
+    with open(os.path.join(model_path, TFIDF_AWARD_IDS_FILE), 'w') as f:
+        json.dump(award_ids, f)
+    print('COMPLETE: TF-IDF model has been saved to ' + model_path)
+
+
+def add_and_populate_index_table(db_filename):
+    '''
+    Takes in a SQL database filename and builds a keyword index from all words
+    in the award titles and abstacts. This index is added to the database as a
+    new table (keyword_index), replacing any previous one (see
+    rebuild_keyword_index).
+    '''
+    rebuild_keyword_index(db_filename)
+
+
 
 if __name__=="__main__":
     num_args = len(sys.argv)
 
-    usage = ("usage: python3 " + sys.argv[0] + " <database.db>" +
+    usage = ("usage: python3 " + sys.argv[0] +
+            " [--fts | --incremental | --trigrams | --tfidf] <database.db>" +
             "\n\t Adds a keyword_index table to the provided database \
-             \n\t and populates it with words from titles/abstracts")
+             \n\t and populates it with words from titles/abstracts \
+             \n\t (--incremental: only indexes awards added since last run) \
+             \n\t (--fts: adds the awards_fts full-text index instead) \
+             \n\t (--trigrams: adds per-award trigram counts instead) \
+             \n\t (--tfidf: saves a TF-IDF trigram model instead)")
 
     if num_args == 2:
         db_filename = sys.argv[1]
         add_and_populate_index_table(db_filename)
-        
+
+    elif num_args == 3 and sys.argv[1] == '--fts':
+        db_filename = sys.argv[2]
+        add_and_populate_fts_table(db_filename)
+
+    elif num_args == 3 and sys.argv[1] == '--incremental':
+        db_filename = sys.argv[2]
+        rebuild_keyword_index(db_filename, incremental=True)
+
+    elif num_args == 3 and sys.argv[1] == '--trigrams':
+        db_filename = sys.argv[2]
+        build_trigram_tables(db_filename)
+
+    elif num_args == 3 and sys.argv[1] == '--tfidf':
+        db_filename = sys.argv[2]
+        build_tfidf_model(db_filename)
+
     else:
         print(usage)
         sys.exit(0)
\ No newline at end of file
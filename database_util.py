@@ -4,39 +4,287 @@
 #
 
 import sys
+import os
 import sqlite3
 import re
-import string
-import nltk
-from nltk.collocations import *
-from nltk.corpus import stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
+import json
+import numpy as np
+from scipy.sparse import csr_matrix
 from nltk.stem.porter import PorterStemmer
+from database_indexer import FTS_TABLE, strip_stopwords
+from database_indexer import TRIGRAM_VOCAB_TABLE, AWARD_TRIGRAMS_TABLE
+from database_indexer import (TFIDF_ARRAYS, TFIDF_VOCABULARY_FILE,
+                              TFIDF_AWARD_IDS_FILE, get_tfidf_model_path)
+from ngram_engine import top_ngrams
+
+# Boolean operators understood in full-text queries (must be upper case)
+FTS_OPERATORS = set(['AND', 'OR', 'NOT'])
+# BM25 weights of the title and abstract columns of the full-text index
+FTS_WEIGHTS = (2.0, 1.0)
+# TF-IDF models already loaded, by database filename (see load_tfidf_model)
+TFIDF_MODELS = {}
+
+def build_keyword_query(keyword_list, db_cursor, any_keywords=None,
+                        exclude_keywords=None):
+    '''
+    Builds a single SQL query over keyword_index for awards that have every
+    keyword in keyword_list, at least one of any_keywords (if given) and
+    none of exclude_keywords (if given).
+
+    The number of awards per keyword is looked up first (one grouped query)
+    so that the query starts from the rarest required keyword and checks
+    each award it finds against the other keywords in turn, through the
+    (keyword, award_id) index built by database_indexer.py.
 
-def keyword_search(keyword_list, db_cursor=None):
+    Inputs:
+        keyword_list (list of strings) : keywords awards must all have
+        db_cursor (sqlite3 cursor) : points to database with keyword_index
+        any_keywords (list of strings) : keywords awards need one of
+        exclude_keywords (list of strings) : keywords awards must not have
+    Returns:
+        (sql_query, params) : query and its parameters, or None if no award
+            can match
+    '''
+    required = list(set(keyword_list))
+    any_keywords = list(set(any_keywords or []))
+    exclude_keywords = list(set(exclude_keywords or []))
+    if not required and not any_keywords:
+        return None
+
+    counts = {}
+    if required:
+        sql_query = '''SELECT keyword, COUNT(*) FROM keyword_index
+                       WHERE keyword IN ({}) GROUP BY keyword'''.format(
+                       ', '.join(['?'] * len(required)))
+        counts = dict(db_cursor.execute(sql_query, required).fetchall())
+        if len(counts) < len(required):
+            return None
+    required.sort(key=lambda kw: counts[kw])
+
+    params = []
+    if required:
+        # CROSS JOIN keeps SQLite from reordering the joins, so the rarest
+        # keyword drives the query
+        tables = ['keyword_index AS k0']
+        conditions = ['k0.keyword = ?']
+        params.append(required[0])
+        for i, kw in enumerate(required[1:], 1):
+            tables.append('keyword_index AS k{}'.format(i))
+            conditions.append('k{0}.keyword = ? AND k{0}.award_id = '
+                              'k0.award_id'.format(i))
+            params.append(kw)
+        if any_keywords:
+            conditions.append('''EXISTS (SELECT 1 FROM keyword_index AS ka
+                                 WHERE ka.keyword IN ({}) AND
+                                 ka.award_id = k0.award_id)'''.format(
+                              ', '.join(['?'] * len(any_keywords))))
+            params += any_keywords
+    else:
+        tables = ['keyword_index AS k0']
+        conditions = ['k0.keyword IN ({})'.format(
+                      ', '.join(['?'] * len(any_keywords)))]
+        params += any_keywords
+    if exclude_keywords:
+        conditions.append('''NOT EXISTS (SELECT 1 FROM keyword_index AS kx
+                             WHERE kx.keyword IN ({}) AND
+                             kx.award_id = k0.award_id)'''.format(
+                          ', '.join(['?'] * len(exclude_keywords))))
+        params += exclude_keywords
+
+    sql_query = 'SELECT DISTINCT k0.award_id FROM {} WHERE {}'.format(
+                ' CROSS JOIN '.join(tables), ' AND '.join(conditions))
+    return (sql_query, params)
+
+
+def keyword_search_pages(keyword_list, db_cursor, any_keywords=None,
+                         exclude_keywords=None, page_size=1000):
+    '''
+    Generator version of keyword_search: runs the query from
+    build_keyword_query and yields the matching award_ids page_size at a
+    time, as SQLite finds them. The query runs on its own cursor, so
+    db_cursor can still be used in between pages.
+
+    Inputs:
+        keyword_list, db_cursor, any_keywords, exclude_keywords :
+            see build_keyword_query
+        page_size (int) : number of award_ids per page
+    Yields:
+        page (list of strings) : award_id strings
+    '''
+    query = build_keyword_query(keyword_list, db_cursor, any_keywords,
+                                exclude_keywords)
+    if query is None:
+        return
+    page_cursor = db_cursor.connection.cursor()
+    page_cursor.execute(*query)
+    page = page_cursor.fetchmany(page_size)
+    while page:
+        yield [award_id for (award_id,) in page]
+        page = page_cursor.fetchmany(page_size)
+    page_cursor.close()
+
+
+def keyword_search(keyword_list, db_cursor=None, any_keywords=None,
+                   exclude_keywords=None):
     '''
     Inputs:
         keyword_list (list of strings) : list of keywords to search for
         db_cursor (SQLite3 Cursor) : Cursor object for nsf.db
+        any_keywords (list of strings) : optional, awards must also match
+            at least one of these keywords
+        exclude_keywords (list of strings) : optional, awards must match
+            none of these keywords
     Returns:
         award_id_set (set of strings) : set of award_id strings corresponding
-            to awards in the NSF database that match all keywords
+            to awards in the NSF database that match all keywords (empty if
+            no keywords are given)
     '''
-    id_dict = {}
-    sql_query = 'SELECT award_id FROM keyword_index WHERE keyword = ?'
-    for kw in keyword_list:
-        results = db_cursor.execute(sql_query, [kw])
-        results = results.fetchall()
-        results = set([award_id for (award_id,) in results])
-        id_dict[kw] = results
-    for count, kw in enumerate(id_dict.keys()):
-        if count == 0:
-            award_id_set = id_dict[kw]
-        else:
-            award_id_set = award_id_set.intersection(id_dict[kw])
+    award_id_set = set()
+    for page in keyword_search_pages(keyword_list, db_cursor, any_keywords,
+                                     exclude_keywords):
+        award_id_set.update(page)
     return award_id_set
 
 
+def has_fts_table(db_cursor):
+    '''
+    Returns True if the database has the awards_fts full-text index (see
+    database_indexer.add_and_populate_fts_table).
+    '''
+    results = db_cursor.execute('''SELECT 1 FROM sqlite_master
+                                   WHERE name = ?''', [FTS_TABLE])
+    return results.fetchone() is not None
+
+
+def balance_parentheses(items):
+    '''
+    Returns the list of query items (see prepare_fts_query) without any
+    parenthesis that has no partner, e.g. the "(" of "(cancer OR therapy".
+    '''
+    unmatched = set()
+    open_positions = []
+    for (i, item) in enumerate(items):
+        if item == '(':
+            open_positions.append(i)
+        elif item == ')':
+            if open_positions:
+                open_positions.pop()
+            else:
+                unmatched.add(i)
+    unmatched.update(open_positions)
+    return [item for (i, item) in enumerate(items) if i not in unmatched]
+
+
+def prepare_fts_query(query):
+    '''
+    Converts a search string into an FTS5 query for the awards_fts index.
+    Supported syntax:
+        cancer therapy          awards containing both words
+        "gene therapy"          the phrase
+        immun*                  words starting with a prefix
+        AND, OR, NOT, ( )       boolean operators (upper case) and grouping
+    Stopwords (database_indexer.INDEX_IGNORE) are removed, as they were from
+    the index, along with any operator they leave dangling and any
+    parenthesis without a partner. NOT excludes what follows it from what
+    comes before it ("AND NOT" is read as NOT), so it can't start a query or
+    group, or follow OR.
+
+    Inputs:
+        query (string) : search string
+    Returns:
+        fts_query (string) : FTS5 query, empty if nothing is left to search
+    Raises:
+        ValueError : if NOT has nothing before it to exclude from
+    '''
+    tokens = re.findall(r'"[^"]*"?|\(|\)|[^\s()"]+', query)
+    items = []
+    for tok in tokens:
+        if tok in ('(', ')') or tok in FTS_OPERATORS:
+            items.append(tok)
+        elif tok.startswith('"'):
+            phrase = strip_stopwords(tok.strip('"'))
+            if phrase:
+                items.append('"{}"'.format(phrase))
+        else:
+            # Quoting each term keeps punctuation from being read as FTS5
+            # syntax; e.g. low-cost becomes the phrase "low cost".
+            words = strip_stopwords(tok)
+            if words:
+                term = '"{}"'.format(words)
+                if tok.endswith('*'):
+                    term += '*'
+                items.append(term)
+
+    fts_items = []
+    for item in balance_parentheses(items):
+        previous = fts_items[-1] if fts_items else None
+        if item == 'NOT' and previous == 'AND':
+            fts_items[-1] = 'NOT'
+            continue
+        if item in FTS_OPERATORS and (previous is None or previous == '(' or
+                                      previous in FTS_OPERATORS):
+            if item == 'NOT':
+                raise ValueError('NOT must follow the terms to exclude from, '
+                                 'e.g. "therapy NOT cancer": ' + query)
+            continue
+        if item == ')':
+            while fts_items and fts_items[-1] in FTS_OPERATORS:
+                fts_items.pop()
+            if fts_items and fts_items[-1] == '(':
+                fts_items.pop()
+                continue
+        elif item not in FTS_OPERATORS and previous is not None and \
+                previous != '(' and previous not in FTS_OPERATORS:
+            # FTS5 only ANDs neighbouring phrases implicitly, not groups
+            fts_items.append('AND')
+        fts_items.append(item)
+    while fts_items and fts_items[-1] in FTS_OPERATORS:
+        fts_items.pop()
+    return ' '.join(fts_items)
+
+
+def full_text_search(query, db_cursor, limit=None, offset=0):
+    '''
+    Searches the awards_fts full-text index, ranking matches with BM25 (words
+    in the title count for more than words in the abstract).
+
+    Inputs:
+        query (string) : search string (see prepare_fts_query for syntax)
+        db_cursor (sqlite3 cursor) : points to database with awards_fts
+        limit (int) : maximum number of results (None for all)
+        offset (int) : number of results to skip, for paging
+    Returns:
+        results (list of tuples) : (award_id, score) for matching awards,
+            best match first (lower scores are better matches)
+    Raises:
+        ValueError : if query starts with NOT (see prepare_fts_query)
+    '''
+    fts_query = prepare_fts_query(query)
+    if not fts_query:
+        return []
+    if limit is None:
+        limit = -1
+    sql_query = '''SELECT awards.award_id, bm25({0}, ?, ?) AS score
+                   FROM {0} JOIN awards ON awards.rowid = {0}.rowid
+                   WHERE {0} MATCH ?
+                   ORDER BY score
+                   LIMIT ? OFFSET ?'''.format(FTS_TABLE)
+    try:
+        results = db_cursor.execute(sql_query, list(FTS_WEIGHTS) +
+                                    [fts_query, limit, offset])
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in str(e):
+            raise
+        # Any query FTS5 still can't parse is searched as a single phrase
+        # of its words
+        fts_query = '"{}"'.format(strip_stopwords(query))
+        if fts_query == '""':
+            return []
+        results = db_cursor.execute(sql_query, list(FTS_WEIGHTS) +
+                                    [fts_query, limit, offset])
+    return results.fetchall()
+
+
 def get_fields_from_award_id(award_id, fields, db_cursor):
     '''
     Inputs:
@@ -57,6 +305,53 @@ def get_fields_from_award_id(award_id, fields, db_cursor):
     return rv
 
 
+def iter_fields_from_award_ids(award_id_list, fields, db_cursor,
+                               null_text=False, chunk_size=500):
+    '''
+    Bulk version of get_fields_from_award_id: fetches the requested columns
+    for many awards with one SELECT ... WHERE award_id IN (...) per
+    chunk_size award_ids (which keeps each query under SQLite's limit on
+    parameters), yielding rows as they are read. Award_ids not in the
+    database are skipped, and rows come back in database order rather than
+    the order of award_id_list.
+
+    Inputs:
+        award_id_list (iterable of strings) : award_id strings
+        fields (list of strings) : column names in awards table
+        db_cursor (sqlite3 cursor) : points to database with awards table
+        null_text (bool) : if True, NULL values are returned as '' so that
+            the fields can be used as text without checking for None
+        chunk_size (int) : number of award_ids per query
+    Yields:
+        row (tuple) : (award_id, field1, field2, ...) for each award found
+    '''
+    if null_text:
+        selection = ', '.join(["COALESCE({}, '')".format(f) for f in fields])
+    else:
+        selection = ', '.join(fields)
+    fetch_cursor = db_cursor.connection.cursor()
+    award_id_list = list(award_id_list)
+    for i in range(0, len(award_id_list), chunk_size):
+        chunk = award_id_list[i:i + chunk_size]
+        sql_query = '''SELECT award_id, {} FROM awards
+                       WHERE award_id IN ({})'''.format(
+                       selection, ', '.join(['?'] * len(chunk)))
+        fetch_cursor.execute(sql_query, chunk)
+        for row in fetch_cursor:
+            yield row
+    fetch_cursor.close()
+
+
+def iter_text_from_award_ids(award_id_list, db_cursor):
+    '''
+    Yields the (title, abstract) of each award in award_id_list, with
+    missing titles or abstracts as '' (see iter_fields_from_award_ids).
+    '''
+    for (award_id, title, abstract) in iter_fields_from_award_ids(
+            award_id_list, ['title', 'abstract'], db_cursor, null_text=True):
+        yield (title, abstract)
+
+
 def get_all_text_from_award_id_list(award_id_list, db_cursor):
     '''
     Returns a list of all titles and a list of all abstracts for the
@@ -72,57 +367,200 @@ def get_all_text_from_award_id_list(award_id_list, db_cursor):
     '''
     title_list = []
     abstract_list = []
-    for award_id in award_id_list:
-        text_dict = get_fields_from_award_id(
-                    award_id, ['title', 'abstract'], db_cursor)
-        title_list.append(text_dict.get('title'))
-        abstract_list.append(text_dict.get('abstract'))
+    for (title, abstract) in iter_text_from_award_ids(award_id_list,
+                                                      db_cursor):
+        title_list.append(title)
+        abstract_list.append(abstract)
     return (title_list, abstract_list)
 
 
 def get_repeated_trigrams(title_list, abstract_list, min_rep, max_return):
-    text = '\n'.join(title_list + abstract_list)
-    text = re.sub(r'[{}]'.format(string.punctuation), '', text)
-    tokens = nltk.wordpunct_tokenize(text)
-    words = [w for w in tokens if not w in stopwords.words('english')]
-    finder = TrigramCollocationFinder.from_words(words)
-    finder.apply_freq_filter(min_rep)
-    trigram_measures = nltk.collocations.TrigramAssocMeasures()
-    scored = finder.score_ngrams(trigram_measures.raw_freq)
+    '''
+    Inputs:
+        title_list (list of strings) : award titles
+        abstract_list (list of strings) : award abstracts
+        min_rep (int) : minimum number of times a trigram must appear
+        max_return (int) : maximum number of trigrams to return
+    Returns:
+        trigram_list (list of tuples) : most frequent trigrams (tuples of
+            three words) first, see ngram_engine.top_ngrams
+
+    Unlike the NLTK collocation finder this used to be built on:
+        - the most frequent trigrams come first (the old list was sorted
+          least frequent first); ties are in alphabetical order
+        - each title and abstract is tokenized on its own, so no trigram
+          spans the end of one document and the start of the next
+        - words are lower-cased before stopwords are removed, so "The" or
+          "We" at the start of a sentence is dropped too, and words that
+          differ only in case are counted together
+    '''
+    return top_ngrams(title_list + abstract_list, 3, min_rep, max_return)
 
-    trigram_list = [(trigram, score) for trigram, score in scored]
-    trigram_list = sorted(trigram_list, key = lambda x: x[1])
-    trigram_list = [trigram for trigram, score in trigram_list]
-    trigram_list = trigram_list[0: min(max_return, len(trigram_list))]
-    return trigram_list
 
+def has_trigram_tables(db_cursor):
+    '''
+    Returns True if the database has the per-award trigram counts (see
+    database_indexer.build_trigram_tables).
+    '''
+    results = db_cursor.execute('''SELECT COUNT(*) FROM sqlite_master
+                                   WHERE type = 'table' AND name IN (?, ?)''',
+                                [TRIGRAM_VOCAB_TABLE, AWARD_TRIGRAMS_TABLE])
+    return results.fetchone()[0] == 2
 
-def tf_idf(tgram, abstract_list):
 
-    tf = TfidfVectorizer(analyzer='word', ngram_range=(3,3), min_df = 0, stop_words = 'english')
-    tf.transform(abstract_list)
+def get_repeated_trigrams_from_table(award_id_list, db_cursor, min_rep,
+                                     max_return):
+    '''
+    Same result as get_repeated_trigrams on the titles and abstracts of the
+    awards in award_id_list, but summed from the precomputed award_trigrams
+    counts: the award_ids are loaded into a temporary table and joined
+    against award_trigrams in one grouped query.
 
+    Inputs:
+        award_id_list (list of strings) : awards to count trigrams over
+        db_cursor (sqlite3 cursor) : points to database with trigram tables
+        min_rep (int) : minimum number of times a trigram must appear
+        max_return (int) : maximum number of trigrams to return
+    Returns:
+        trigram_list (list of tuples) : most frequent trigrams (tuples of
+            three words) first
+    '''
+    db_cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS search_awards
+                         (award_id text primary key);''')
+    db_cursor.execute('DELETE FROM temp.search_awards;')
+    db_cursor.executemany('''INSERT OR IGNORE INTO temp.search_awards
+                             VALUES (?);''',
+                          [(award_id,) for award_id in award_id_list])
+    # CROSS JOIN keeps SQLite from scanning all of award_trigrams (it has no
+    # statistics for the temporary table), so only the searched awards' rows
+    # are read through the (award_id, trigram_id, count) index
+    sql_query = '''SELECT v.trigram, totals.total
+                   FROM (SELECT t.trigram_id, SUM(t.count) AS total
+                         FROM temp.search_awards AS s
+                         CROSS JOIN {1} AS t ON t.award_id = s.award_id
+                         GROUP BY t.trigram_id
+                         HAVING total >= ?) AS totals
+                   JOIN {0} AS v ON v.trigram_id = totals.trigram_id
+                   ORDER BY totals.total DESC, v.trigram
+                   LIMIT ?'''.format(TRIGRAM_VOCAB_TABLE, AWARD_TRIGRAMS_TABLE)
+    results = db_cursor.execute(sql_query, [min_rep, max_return]).fetchall()
+    db_cursor.execute('DELETE FROM temp.search_awards;')
+    return [tuple(trigram.split(' ')) for (trigram, total) in results]
+
+
+def load_tfidf_model(db_filename):
+    '''
+    Loads the TF-IDF model saved for a database by
+    database_indexer.build_tfidf_model, memory-mapping the matrix arrays so
+    only the rows a search uses are read from disk. Models are loaded once
+    per process and kept in TFIDF_MODELS.
 
-def search_database_for_trigrams(db_filename, keyword_list, min_rep = 3, max_return = 50):
+    Inputs:
+        db_filename (string) : database the model was built from
+    Returns:
+        model (dictionary) : 'matrix' (scipy CSR matrix, one row per award),
+            'vocabulary' (list of the trigram of each column) and 'rows'
+            (dictionary mapping award_id, as a string : matrix row)
+    '''
+    if db_filename in TFIDF_MODELS:
+        return TFIDF_MODELS[db_filename]
+    model_path = get_tfidf_model_path(db_filename)
+    if not os.path.exists(model_path):
+        raise FileNotFoundError('No TF-IDF model for {} (build one with '
+                                'python3 database_indexer.py --tfidf {})'
+                                .format(db_filename, db_filename))
+    (data, indices, indptr) = [np.load(os.path.join(model_path, name + '.npy'),
+                                       mmap_mode='r')
+                               for name in TFIDF_ARRAYS]
+    with open(os.path.join(model_path, TFIDF_VOCABULARY_FILE)) as f:
+        vocabulary = json.load(f)
+    with open(os.path.join(model_path, TFIDF_AWARD_IDS_FILE)) as f:
+        award_ids = json.load(f)
+    matrix = csr_matrix((data, indices, indptr),
+                        shape=(len(award_ids), len(vocabulary)), copy=False)
+    model = {'matrix': matrix,
+             'vocabulary': vocabulary,
+             'rows': {str(award_id): row for (row, award_id) in
+                      enumerate(award_ids)}}
+    TFIDF_MODELS[db_filename] = model
+    return model
+
+
+def tf_idf(award_id_list, tfidf_model, max_return=50):
+    '''
+    Ranks the trigrams of a set of awards by their TF-IDF scores summed over
+    the awards, so trigrams common to many of the awards but rare in the
+    database as a whole come first. Scores are read from the rows of the
+    precomputed model (see load_tfidf_model); award_ids not in the model
+    (e.g. added after it was built) are skipped.
+
+    Inputs:
+        award_id_list (list of strings) : awards to rank trigrams over
+        tfidf_model (dictionary) : as returned by load_tfidf_model
+        max_return (int) : maximum number of trigrams to return
+    Returns:
+        trigram_list (list of tuples) : highest scoring trigrams (tuples of
+            three words) first
+    '''
+    rows = tfidf_model['rows']
+    # keyword_search returns NSF award_ids as ints (keyword_index.award_id
+    # has integer affinity), while the model's come from awards as text
+    award_id_list = [str(award_id) for award_id in award_id_list]
+    row_list = sorted(set(rows[award_id] for award_id in award_id_list
+                          if award_id in rows))
+    if not row_list or max_return <= 0:
+        return []
+    submatrix = tfidf_model['matrix'][row_list]
+    scores = np.bincount(submatrix.indices, weights=submatrix.data,
+                         minlength=submatrix.shape[1])
+    columns = np.flatnonzero(scores)
+    if len(columns) > max_return:
+        columns = columns[np.argpartition(-scores[columns],
+                                          max_return - 1)[:max_return]]
+    columns = sorted(columns, key=lambda col: (-scores[col],
+                                               tfidf_model['vocabulary'][col]))
+    return [tuple(tfidf_model['vocabulary'][col].split(' '))
+            for col in columns]
+
+
+def search_database_for_trigrams(db_filename, keyword_list, min_rep = 3,
+                                 max_return = 50, ranking = 'count'):
+    '''
+    Finds the awards matching keyword_list and returns their most notable
+    trigrams: with ranking = 'count', those appearing most often (at least
+    min_rep times); with ranking = 'tfidf', those with the highest summed
+    TF-IDF scores in the database's TF-IDF model (min_rep is not used).
+    '''
     conn = sqlite3.connect(db_filename)
     c = conn.cursor()
 
-    award_id_set = keyword_search(keyword_list, c)
-    award_id_list = list(award_id_set)
-
-    (t_list, a_list) = get_all_text_from_award_id_list(award_id_list, c)
-
-    trigrams = get_repeated_trigrams(t_list, a_list, min_rep, max_return)
-
-    return trigrams
+    if has_fts_table(c):
+        results = full_text_search(' '.join(keyword_list), c)
+        award_id_list = [award_id for (award_id, score) in results]
+    else:
+        award_id_set = keyword_search(keyword_list, c)
+        award_id_list = list(award_id_set)
+
+    if ranking == 'tfidf':
+        trigrams = tf_idf(award_id_list, load_tfidf_model(db_filename),
+                          max_return)
+    elif has_trigram_tables(c):
+        trigrams = get_repeated_trigrams_from_table(award_id_list, c,
+                                                    min_rep, max_return)
+    else:
+        # Titles and abstracts are read and counted one award at a time
+        documents = (text for (title, abstract) in
+                     iter_text_from_award_ids(award_id_list, c)
+                     for text in (title, abstract))
+        trigrams = top_ngrams(documents, 3, min_rep, max_return)
 
     #
     # Do something with trigrams
     #
     #
 
-    conn.commit() # Save database
     conn.close() # Close database
+    return trigrams
 
 
 if __name__=="__main__":
@@ -134,14 +572,22 @@ if __name__=="__main__":
 
     num_args = len(sys.argv)
 
-    usage = ("usage: python3 " + sys.argv[0] + " <database.db> <term1> <term2> ..." +
+    usage = ("usage: python3 " + sys.argv[0] + " [--tfidf] <database.db> <term1> <term2> ..." +
                  '\n\tPlease provide database filename and \
-                  \n\tkeywords to search for (separated by space)')
+                  \n\tkeywords to search for (separated by space) \
+                  \n\t(--tfidf: rank trigrams by TF-IDF instead of count)')
+
+    ranking = 'count'
+    if num_args > 1 and sys.argv[1] == '--tfidf':
+        ranking = 'tfidf'
+        sys.argv.pop(1)
+        num_args -= 1
 
     if num_args > 2:
         db_filename = sys.argv[1]
         keyword_list = sys.argv[2:num_args]
-        trigrams = search_database_for_trigrams(db_filename, keyword_list)
+        trigrams = search_database_for_trigrams(db_filename, keyword_list,
+                                                ranking=ranking)
         print('= == === ==== RESULTS ==== === == =')
         for t in trigrams:
             print(t)
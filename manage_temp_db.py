@@ -18,7 +18,7 @@ import time
 import subprocess
 import sqlite3
 from check_os import is_VM
-from JS_browser import JS_browser
+from browser_pool import get_pool
 from collect_TAGG import setup_database
 from populate_TAGG_search import search as TAGG_search
 from nsf_scrape_search_result import run_search_scraper
@@ -45,31 +45,30 @@ def get_counts_for_search(search):
     if "NSF" in search["agency"]:
         url = generate_nsf_GET(search)
         num_result_element = '//div[@class="my-paging-display x-component"]'
-        browser = JS_browser(download_path, start_link = url)
-        # See explanation in download_nsf_search in this file.
-        nsf_count = int(browser._find(num_result_element).text.split()[-1])
+        # Browsers come from a pool kept running between searches.
+        with get_pool().browser(download_path, start_link = url) as browser:
+            # See explanation in download_nsf_search in this file.
+            nsf_count = int(browser._find(num_result_element).text.split()[-1])
         print(nsf_count)
-        browser.cleanup()
     if "CDC" in search["agency"] or "NIH" in search["agency"]:
         sub_search = search.copy()
         sub_search["agency"] = [value for value in search["agency"] if 
                                 value != "NSF"]
-        # The value of "download_path" here is irrelevant since we won't
-        # download anything; it's just good to use a valid path.
-        browser = JS_browser(save_path = "/")
-        browser.go_to("https://taggs.hhs.gov/SearchAdv")
         years = search["years"]
         agency = sub_search["agency"]
         usa = search["US_awards"]
         intl = not usa
         keywords = search["keywords"]
-        TAGG_search(browser, years = years, agency = agency, usa = usa,
-                    intl = intl, keywords = keywords)
         award_count_elem = ('//div[.//text()="Distinct Award Count: "]/'
                             'following-sibling::div')
-        taggs_count = int(browser._find(award_count_elem).text)
+        # The value of "download_path" here is irrelevant since we won't
+        # download anything; it's just good to use a valid path.
+        with get_pool().browser(download_path,
+                start_link = "https://taggs.hhs.gov/SearchAdv") as browser:
+            TAGG_search(browser, years = years, agency = agency, usa = usa,
+                        intl = intl, keywords = keywords)
+            taggs_count = int(browser._find(award_count_elem).text)
         print(taggs_count)
-        browser.cleanup()
     
     total_count = nsf_count + taggs_count
     for count in [nsf_count, taggs_count, total_count]:
@@ -267,18 +266,18 @@ def download_nsf_search(url, download_path):
     num_result_element = '//div[@class="my-paging-display x-component"]'
     # Award.xml is the file name given by the website. We needn't bother
     # renaming this file as we'll just delete it once we're done.
-    browser = JS_browser(download_path, start_link = url)
-    # I realize it's not quite ideal to call a hidden method like this,
-    # but the code required to get the number of search results in the NSF data
-    # is pretty specific and thus it doesn't really seem appropriate to make
-    # a method within the JS_browser class specifically for that purpose.
-    # The text of the element at XPath num_result_element will be like:
-    # "Displaying 1 - 30 of 3000"
-    # So num_results would become 3000 in this case.
-    num_results = browser._find(num_result_element).text.split()[-1]
-    download_path += "Awards.xml"
-    browser.download(xml_download_element, download_path)
-    browser.cleanup()
+    with get_pool().browser(download_path, start_link = url) as browser:
+        # I realize it's not quite ideal to call a hidden method like this,
+        # but the code required to get the number of search results in the
+        # NSF data is pretty specific and thus it doesn't really seem
+        # appropriate to make a method within the JS_browser class
+        # specifically for that purpose.
+        # The text of the element at XPath num_result_element will be like:
+        # "Displaying 1 - 30 of 3000"
+        # So num_results would become 3000 in this case.
+        num_results = browser._find(num_result_element).text.split()[-1]
+        download_path += "Awards.xml"
+        browser.download(xml_download_element, download_path)
     return num_results, download_path
 
 
@@ -0,0 +1,105 @@
+# N-gram counting engine for trigram topics of award search results
+#
+# Mark Saddler / MVR
+#
+# Counts the word n-grams (trigrams by default) of award titles and abstracts,
+# one document at a time, with the NLTK stopword list loaded only once. Used by
+# database_util.py in place of joining all documents into one string and
+# running nltk's TrigramCollocationFinder over it.
+
+import re
+import string
+import heapq
+from collections import Counter
+from nltk.corpus import stopwords
+
+PUNCTUATION_RE = re.compile('[{}]'.format(re.escape(string.punctuation)))
+# Same tokens as nltk.wordpunct_tokenize
+TOKEN_RE = re.compile(r'\w+|[^\w\s]+')
+
+_stopword_set = None
+
+
+def get_stopword_set():
+    '''
+    Returns the set of English stopwords from NLTK, loading the list the first
+    time it is needed rather than on every lookup.
+    '''
+    global _stopword_set
+    if _stopword_set is None:
+        _stopword_set = frozenset(stopwords.words('english'))
+    return _stopword_set
+
+
+def tokenize(text, stopword_set=None):
+    '''
+    Inputs:
+        text (string) : a single title or abstract
+        stopword_set (set of strings) : words to drop (default: NLTK English
+            stopwords, see get_stopword_set)
+    Returns:
+        words (list of strings) : lower-cased words of text, without
+            punctuation or stopwords
+    '''
+    if stopword_set is None:
+        stopword_set = get_stopword_set()
+    if not text:
+        return []
+    text = PUNCTUATION_RE.sub('', text.lower())
+    return [w for w in TOKEN_RE.findall(text) if w not in stopword_set]
+
+
+def ngrams(text, n=3, stopword_set=None):
+    '''
+    Inputs:
+        text (string) : a single title or abstract
+        n (int) : number of words per n-gram
+        stopword_set (set of strings) : see tokenize
+    Returns:
+        ngram_list (list of tuples) : the n-grams of words in text, in order
+            and with repeats
+    '''
+    words = tokenize(text, stopword_set)
+    return list(zip(*[words[i:] for i in range(n)]))
+
+
+def count_ngrams(documents, n=3, min_count=1, stopword_set=None):
+    '''
+    Counts the n-grams of words in each document. N-grams are counted within
+    documents only, never across the end of one and the start of the next.
+    Documents are consumed one at a time, so "documents" can be a generator
+    (e.g. database_util.iter_text_from_award_ids).
+
+    Inputs:
+        documents (iterable of strings) : titles and/or abstracts
+        n (int) : number of words per n-gram
+        min_count (int) : n-grams seen fewer times than this are dropped
+        stopword_set (set of strings) : see tokenize
+    Returns:
+        counts (Counter) : maps n-gram (tuple of words) to its count
+    '''
+    if stopword_set is None:
+        stopword_set = get_stopword_set()
+    counts = Counter()
+    for document in documents:
+        counts.update(ngrams(document, n, stopword_set))
+    if min_count > 1:
+        counts = Counter({ngram: count for (ngram, count) in counts.items()
+                          if count >= min_count})
+    return counts
+
+
+def top_ngrams(documents, n=3, min_count=1, max_return=50,
+               stopword_set=None):
+    '''
+    Inputs:
+        documents, n, min_count, stopword_set : see count_ngrams
+        max_return (int) : maximum number of n-grams to return
+    Returns:
+        ngram_list (list of tuples) : the most frequent n-grams, most
+            frequent first (ties in alphabetical order)
+    '''
+    counts = count_ngrams(documents, n, min_count, stopword_set)
+    top = heapq.nsmallest(max_return, counts.items(),
+                          key=lambda item: (-item[1], item[0]))
+    return [ngram for (ngram, count) in top]
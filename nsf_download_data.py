@@ -4,11 +4,16 @@
 #
 
 import os
+import sys
+import time
 import requests
 import bs4
-import urllib
+import urllib.request
+import urllib.error
+import http.client
 import re
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 def get_soup_from_url(url):
@@ -34,26 +39,134 @@ def get_data_links(soup, url):
     return data_links
 
 
-def download_zipfile(url, zip_file_path):
+def get_zipfile_name(url, zip_file_path):
     '''
-    Download a zip file (containing all award XML files from a single year)
+    Get the path a download link is saved to: <zip_file_path>/<year>.zip,
+    or None if the link doesn't name a download file
     '''
-    pattern = r'DownloadFileName=\w*'
-    match = re.search(pattern,url)
+    match = re.search(r'DownloadFileName=(\w*)', url)
     if match:
-        dl_fn = match.group().strip('DownloadFileName=')
-        dl_fn = zip_file_path + dl_fn
-        return urllib.request.urlretrieve(url, dl_fn)
-    else:
+        return os.path.join(zip_file_path, match.group(1) + '.zip')
+    return None
+
+
+def download_zipfile(url, zip_file_path, retries = 5, chunk_size = 1 << 20):
+    '''
+    Download a zip file (containing all award XML files from a single year)
+    to <zip_file_path>/<year>.zip. nsf_scrape.py reads the awards straight
+    from this archive, so it no longer needs to be extracted.
+
+    The file is written to <year>.zip.part first and only renamed once its
+    size matches the size reported by the server. If the transfer breaks
+    off, or a .part file is left over from an earlier run, the download
+    resumes from where it stopped with an HTTP Range request. Server errors
+    (5xx) and 429 responses are retried too; other HTTP errors are raised
+    at once. Returns the path of the downloaded file, or None for a link
+    that isn't a download.
+    '''
+    dl_fn = get_zipfile_name(url, zip_file_path)
+    if not dl_fn:
         print('Incompatible download link')
         return None
-    # Returns tuple: (dl_fn, headers)
+    if os.path.exists(dl_fn):
+        print('Already downloaded: ' + dl_fn)
+        return dl_fn
+    part_fn = dl_fn + '.part'
+
+    for attempt in range(retries):
+        try:
+            total_size = download_part(url, part_fn, chunk_size)
+        except urllib.error.HTTPError as e:
+            # HTTPError is a URLError too, but only server errors and rate
+            # limiting are worth retrying; a missing or forbidden file isn't.
+            if e.code < 500 and e.code != 429:
+                raise
+            print('Download of {} failed ({}), retrying'.format(dl_fn, e))
+            time.sleep(2 ** attempt)
+            continue
+        except (urllib.error.URLError, http.client.HTTPException,
+                ConnectionError, TimeoutError) as e:
+            print('Download of {} interrupted ({}), resuming'.format(dl_fn, e))
+            time.sleep(2 ** attempt)
+            continue
+        part_size = os.path.getsize(part_fn)
+        if total_size is not None and part_size != total_size:
+            print('Download of {} incomplete ({} of {} bytes), resuming'.format(
+                  dl_fn, part_size, total_size))
+            continue
+        os.replace(part_fn, dl_fn)
+        return dl_fn
+    raise RuntimeError('Failed to download {} after {} attempts'.format(
+                       url, retries))
+
+
+def download_part(url, part_fn, chunk_size = 1 << 20):
+    '''
+    Helper function for download_zipfile: fetch "url" into part_fn, asking
+    the server only for the bytes past what part_fn already holds. Returns
+    the full size of the file according to the server, if it says.
+    '''
+    have = 0
+    if os.path.exists(part_fn):
+        have = os.path.getsize(part_fn)
+    request = urllib.request.Request(url)
+    if have:
+        request.add_header('Range', 'bytes={}-'.format(have))
+    try:
+        response = urllib.request.urlopen(request, timeout = 60)
+    except urllib.error.HTTPError as e:
+        if e.code == 416:
+            # Nothing left past the end of the .part file: the size in the
+            # Content-Range header ("bytes */<size>") tells whether it is
+            # actually complete.
+            match = re.search(r'/(\d+)', e.headers.get('Content-Range', ''))
+            return int(match.group(1)) if match else None
+        raise
+    with response:
+        if response.status == 206:
+            mode = 'ab'
+            match = re.search(r'/(\d+)',
+                              response.headers.get('Content-Range', ''))
+            total_size = int(match.group(1)) if match else None
+        else:
+            # The server ignored the Range header and is sending everything.
+            mode = 'wb'
+            have = 0
+            total_size = None
+        length = response.headers.get('Content-Length')
+        if total_size is None and length is not None:
+            total_size = have + int(length)
+        with open(part_fn, mode) as f:
+            chunk = response.read(chunk_size)
+            while chunk:
+                f.write(chunk)
+                chunk = response.read(chunk_size)
+    return total_size
+
+
+def download_years(link_list, zip_file_path, workers = 5):
+    '''
+    Download the zip files for several years at once, on "workers" threads.
+    Returns the list of downloaded file paths.
+    '''
+    if not os.path.exists(zip_file_path):
+        os.makedirs(zip_file_path)
+    for link in link_list:
+        print('Downloading: ' + link)
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        zip_files = list(executor.map(
+            lambda link: download_zipfile(link, zip_file_path), link_list))
+    for zip_file in zip_files:
+        if zip_file:
+            print('Downloaded zipfile: ' + zip_file)
+    return zip_files
 
 
 def extract_zipfile(zipped_directory, output_directory):
     '''
     Extract downloaded zip file to the output directory and delete the
-    zipped directory
+    zipped directory. Only needed to inspect the XML files by hand, since
+    nsf_scrape.py can read the zip file directly.
     '''
     z = zipfile.ZipFile(zipped_directory, 'r')
     z.extractall(output_directory)
@@ -61,16 +174,38 @@ def extract_zipfile(zipped_directory, output_directory):
     os.remove(zipped_directory)
 
 
+def run_download(url = 'https://www.nsf.gov/awardsearch/download.jsp',
+    zip_file_path = 'data/nsf/', num_years = 5, workers = 5):
+    '''
+    Download the zip files for the "num_years" most recent years listed on
+    the NSF download page at "url" (which can point at a local stand-in
+    server for testing) into zip_file_path.
+    '''
+    soup = get_soup_from_url(url)
+    link_list = get_data_links(soup, url)
+    return download_years(link_list[0:num_years], zip_file_path, workers)
+
 
-url = 'https://www.nsf.gov/awardsearch/download.jsp' # Website for NSF data
-soup = get_soup_from_url(url)
-link_list = get_data_links(soup, url)
+if __name__=="__main__":
 
-zip_file_path = '/home/student/cs122_MVR/data/nsf/temp'
+    usage = ("usage: python3 " + sys.argv[0] + " [--years N] [--workers N]"
+             " [--dest <path/>] [--url <download page>]" +
+             "\n\t Downloads the zip files of the N (default 5) most recent "
+             "years of NSF awards \n\t into <path/> (default data/nsf/), "
+             "several at a time.")
 
-for tmp_link in link_list[0:5]: # <----------- Download 5 most recent years
-    print('Downloading: ' + tmp_link)
-    (zip_file, headers) = download_zipfile(tmp_link, zip_file_path)
-    print('Extracting zipfile: ' + zip_file)
-    data_file = zip_file.replace('temp', '')
-    extract_zipfile(zip_file, data_file)
\ No newline at end of file
+    options = {'--years': 5, '--workers': 5, '--dest': 'data/nsf/',
+               '--url': 'https://www.nsf.gov/awardsearch/download.jsp'}
+    args = sys.argv[1:]
+    if len(args) % 2 or any(arg not in options for arg in args[0::2]):
+        print(usage)
+        sys.exit(0)
+    for (option, value) in zip(args[0::2], args[1::2]):
+        options[option] = value
+    try:
+        num_years = int(options['--years'])
+        workers = int(options['--workers'])
+    except ValueError:
+        print(usage)
+        sys.exit(0)
+    run_download(options['--url'], options['--dest'], num_years, workers)
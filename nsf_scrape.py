@@ -6,7 +6,21 @@
 import sys
 import os
 import bs4
+import time
+import zlib
+import queue
 import sqlite3
+import zipfile
+import functools
+import multiprocessing
+from lxml import etree
+from bulk_writer import BulkWriter, AWARD_TABLE_COLUMNS
+
+# Tables written while scraping: the award tables plus the ingest manifest,
+# which records each XML file that has been scraped (see init_manifest).
+SCRAPER_TABLE_COLUMNS = dict(AWARD_TABLE_COLUMNS)
+SCRAPER_TABLE_COLUMNS['ingest_manifest'] = ['file_name', 'size', 'mtime',
+                                            'checksum', 'ingested_at']
 
 def get_list_of_xml_filenames(path):
     '''
@@ -21,6 +35,114 @@ def get_list_of_xml_filenames(path):
     return xml_filenames
 
 
+def get_list_of_zip_members(zip_filename):
+    '''
+    Get the XML files in a downloaded NSF zip archive (a single year's-worth
+    of awards) as (zip_filename, member name) pairs, which open_xml_source
+    reads straight from the archive without extracting it
+    '''
+    with zipfile.ZipFile(zip_filename) as archive:
+        names = archive.namelist()
+    return [(zip_filename, name) for name in names if name.endswith('.xml')]
+
+
+def get_xml_sources(year):
+    '''
+    Get the data path and the XML sources for a single year of awards. The
+    downloaded archive 'data/nsf/<year>.zip' is read directly if it exists;
+    otherwise the extracted folder 'data/nsf/<year>/' is listed. "year" may
+    also be the path of a zip archive.
+    '''
+    year = str(year)
+    if year.endswith('.zip'):
+        data_path = year
+    else:
+        data_path = 'data/nsf/{}.zip'.format(year)
+    if os.path.isfile(data_path):
+        return (data_path, get_list_of_zip_members(data_path))
+    data_path = 'data/nsf/{}/'.format(year)
+    return (data_path, get_list_of_xml_filenames(data_path))
+
+
+# Zip archives opened by open_xml_source, kept open so that every member
+# doesn't re-read the archive's central directory. Each worker process of
+# run_parallel_scraper opens its own (see reset_open_archives).
+_open_archives = {}
+
+def open_xml_source(xml_source):
+    '''
+    Open an XML source from get_xml_sources for reading in binary mode:
+    either a filename or a (zip_filename, member name) pair
+    '''
+    if isinstance(xml_source, tuple):
+        (zip_filename, name) = xml_source
+        return get_zip_archive(zip_filename).open(name)
+    return open(xml_source, 'rb')
+
+
+def get_zip_archive(zip_filename):
+    '''
+    Helper function returning the open ZipFile for a downloaded archive
+    '''
+    if zip_filename not in _open_archives:
+        _open_archives[zip_filename] = zipfile.ZipFile(zip_filename)
+    return _open_archives[zip_filename]
+
+
+def reset_open_archives():
+    '''
+    Forget the zip archives opened so far. Used as the initializer of the
+    run_parallel_scraper pool: forked workers would otherwise share the
+    parent's file offsets when reading from the same archive.
+    '''
+    global _open_archives
+    _open_archives = {}
+
+
+def get_xml_source_name(xml_source):
+    '''
+    Name of an XML source as recorded in the ingest manifest: the bare
+    file name (e.g. '1700001.xml'), so an award file is recognised whether it
+    is read from the zip archive or from the extracted folder
+    '''
+    if isinstance(xml_source, tuple):
+        return os.path.basename(xml_source[1])
+    return os.path.basename(xml_source)
+
+
+def get_xml_source_stat(xml_source):
+    '''
+    Get (size, mtime, checksum) of an XML source without reading it. The
+    checksum (CRC-32 of the contents) is free for zip members since it is
+    stored in the archive, and None for files on disk.
+    '''
+    if isinstance(xml_source, tuple):
+        (zip_filename, name) = xml_source
+        info = get_zip_archive(zip_filename).getinfo(name)
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        return (info.file_size, mtime, info.CRC)
+    stat = os.stat(xml_source)
+    return (stat.st_size, stat.st_mtime, None)
+
+
+def get_xml_source_checksum(xml_source, chunk_size=1 << 20):
+    '''
+    Get the CRC-32 checksum of an XML source's contents: the one stored in
+    the archive for zip members, otherwise computed from the file a chunk at
+    a time so that the whole file is never held in memory.
+    '''
+    checksum = get_xml_source_stat(xml_source)[2]
+    if checksum is not None:
+        return checksum
+    checksum = 0
+    with open_xml_source(xml_source) as xml_file:
+        chunk = xml_file.read(chunk_size)
+        while chunk:
+            checksum = zlib.crc32(chunk, checksum)
+            chunk = xml_file.read(chunk_size)
+    return checksum
+
+
 def get_soup_from_xml_filename(fn):
     '''
     Convert XML file into a BeautifulSoup object
@@ -70,6 +192,71 @@ def parse_subdivided_tag(tag, award_dict):
     award_dict[tag.name] = tmp_list
 
 
+def get_award_from_xml_filename(fn):
+    '''
+    Streaming alternative to get_soup_from_xml_filename + parse_soup: parse
+    an award XML file (or open file object) with lxml's iterparse and return
+    the same dictionary of award fields that parse_soup produces. Each field
+    tag is cleared as soon as it has been read, so memory use stays constant
+    no matter how long the abstract or investigator lists are.
+    '''
+    award = {}
+    subdivided_tags = ['investigator', 'institution',
+                       'organization', 'programelement', 'programreference']
+    started = False
+    context = etree.iterparse(fn, events=('end',), recover=True)
+    for (event, elem) in context:
+        parent = elem.getparent()
+        # Only the direct children of <Award> are fields; anything deeper is
+        # read through its parent below.
+        if parent is None or parent.tag.lower() != 'award':
+            continue
+        name = elem.tag.lower()
+        # parse_soup starts its walk at the title tag, so match that here.
+        started = started or name == 'awardtitle'
+        if started:
+            if name == 'awardinstrument':
+                tmp_list = award.get(name, [])
+                for child in iter_child_tags(elem):
+                    tmp_list.append(get_tag_text(child))
+                award[name] = tmp_list
+            elif name in subdivided_tags:
+                tmp_list = award.get(name, [])
+                sub_dict = {}
+                for child in iter_child_tags(elem):
+                    value = get_tag_text(child)
+                    if len(value) > 0:
+                        sub_dict[child.tag.lower()] = value
+                tmp_list.append(sub_dict)
+                award[name] = tmp_list
+            else:
+                award[name] = get_tag_text(elem)
+        # Free the field we just read, along with any finished siblings.
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+    del context
+    return award
+
+
+def iter_child_tags(elem):
+    '''
+    Helper function to walk all nested tags (but not comments or processing
+    instructions) below an lxml element, like BeautifulSoup's findChildren
+    '''
+    for child in elem.iterdescendants():
+        if isinstance(child.tag, str):
+            yield child
+
+
+def get_tag_text(elem):
+    '''
+    Helper function returning the stripped text of an lxml element and
+    everything nested below it, like BeautifulSoup's .text
+    '''
+    return ''.join(elem.itertext()).strip()
+
+
 def init_db(db_filename):
     '''
     Initialize the NSF award database, which has the following tables:
@@ -116,10 +303,64 @@ def init_db(db_filename):
     return (conn, c)
 
 
-def add_award_to_db(award, c):
+def init_manifest(c):
+    '''
+    Add the ingest manifest table to the NSF award database if it is not
+    there yet. It has one row per scraped XML file (file name, size, mtime,
+    CRC-32 checksum and time of ingest), which is committed together with
+    that file's award rows. Re-runs skip files whose manifest entry still
+    matches, and an interrupted run picks up from the last committed batch.
+    '''
+    c.execute('''CREATE TABLE IF NOT EXISTS ingest_manifest
+                 (file_name text,
+                  size int,
+                  mtime real,
+                  checksum int,
+                  ingested_at text,
+                  constraint pk_ingest_manifest primary key (file_name));''')
+
+
+def load_manifest(c):
+    '''
+    Return the ingest manifest as a dictionary mapping file name :
+    (size, mtime, checksum)
+    '''
+    c.execute('SELECT file_name, size, mtime, checksum FROM ingest_manifest;')
+    return {row[0]: row[1:] for row in c.fetchall()}
+
+
+def get_ingest_jobs(xml_list, manifest):
+    '''
+    Compare the XML sources of one year to the ingest manifest and return
+    (xml_source, known_checksum) pairs for the ones that may have changed.
+    Members of a zip archive are skipped if their stored checksum matches the
+    manifest (their mtimes only have 2-second resolution and are often kept
+    when an archive is repacked), files on disk if their size and mtime
+    match; either way without being read. known_checksum is None for files
+    that have never been ingested.
+    '''
+    jobs = []
+    for xml_source in xml_list:
+        entry = manifest.get(get_xml_source_name(xml_source))
+        if entry is None:
+            jobs.append((xml_source, None))
+            continue
+        (size, mtime, checksum) = get_xml_source_stat(xml_source)
+        if checksum is not None:
+            if checksum == entry[2]:
+                continue
+        elif (size, mtime) == tuple(entry[:2]):
+            continue
+        jobs.append((xml_source, entry[2]))
+    return jobs
+
+
+def get_award_rows(award):
     '''
     Take in a dictionary (award), which contains all of the fields parsed from
-    a single XML file, and insert all fields into the NSF database.
+    a single XML file, and return the rows to insert into each table of the
+    NSF database as a dictionary mapping table name : list of rows (ordered
+    as in bulk_writer.AWARD_TABLE_COLUMNS).
     '''
     award_id = int(award.get('awardid', None))
     title = award.get('awardtitle', '').\
@@ -130,10 +371,11 @@ def add_award_to_db(award, c):
     start_date = award.get('awardeffectivedate', '')
     end_date = award.get('awardexpirationdate', '')
 
-    c.execute('''INSERT OR REPLACE INTO awards (award_id, title, abstract,
-                                                amount, start_date, end_date)
-                 VALUES (?, ?, ?, ?, ?, ?);''',
-                 (award_id, title, abstract, amount, start_date, end_date))
+    rows = {'awards': [(award_id, title, abstract, amount, start_date,
+                        end_date)],
+            'investigators': [],
+            'institutions': [],
+            'organizations': []}
 
     for inv in award.get('investigator', []):
         first_name = inv.get('firstname', '').replace('\'', '').replace('\"', '')
@@ -141,10 +383,8 @@ def add_award_to_db(award, c):
         email = inv.get('emailaddress', '').replace('\'', '').replace('\"', '')
         role = inv.get('rolecode', '').replace('\'', '').replace('\"', '')
 
-        c.execute('''INSERT OR REPLACE INTO investigators (award_id, last_name,
-                     first_name, role, email)
-                     VALUES (?, ?, ?, ?, ?);''',
-                     (award_id, last_name, first_name, role, email))
+        rows['investigators'].append(
+            (award_id, last_name, first_name, role, email))
 
     for inst in award.get('institution', []):
         name = inst.get('name', '').replace('\'', '').replace('\"', '')
@@ -154,60 +394,259 @@ def add_award_to_db(award, c):
         country = inst.get('countryname', '').replace('\'', '').replace('\"', '')
         address = inst.get('streetaddress', '').replace('\'', '').replace('\"', '')
 
-        c.execute('''INSERT OR REPLACE INTO institutions (award_id, name,
-                     city, address, state, zipcode, country)
-                     VALUES (?, ?, ?, ?, ?, ?, ?);''',
-                     (award_id, name, city, address, state_code, zipcode, country))
+        rows['institutions'].append(
+            (award_id, name, address, city, state_code, zipcode, country))
 
     for org in award.get('organization', []):
         organization_code = org.get('code', None)
         directorate = org.get('directorate', None)
         division = org.get('division', None)
 
-        c.execute('''INSERT OR REPLACE INTO organizations (award_id,
-                     organization_code, directorate, division)
-                     VALUES (?, ?, ?, ?);''',
-                     (award_id, organization_code, directorate, division))
+        rows['organizations'].append(
+            (award_id, organization_code, directorate, division))
+
+    return rows
+
+
+def add_award_to_db(award, writer):
+    '''
+    Take in a dictionary (award), which contains all of the fields parsed from
+    a single XML file, and queue all fields for insertion into the NSF
+    database through "writer" (a bulk_writer.BulkWriter).
+    '''
+    writer.add_rows(get_award_rows(award))
 
 
 ##############################################################################
 # Run script
 ##############################################################################
 
-def run_scraper(years, db_filename):
+def parse_award_xml(xml_file, stream=False):
+    '''
+    Parse an open award XML file into an award dictionary with either the
+    BeautifulSoup parser or, if stream=True, the lxml iterparse parser.
+    '''
+    if stream:
+        return get_award_from_xml_filename(xml_file)
+    soup = bs4.BeautifulSoup(xml_file)
+    return parse_soup(soup)
+
+
+def parse_award_file(xml_source, stream=False):
+    '''
+    Parse a single award XML file (an XML source from get_xml_sources) into
+    an award dictionary (see parse_award_xml).
+    '''
+    with open_xml_source(xml_source) as xml_file:
+        return parse_award_xml(xml_file, stream=stream)
+
+
+def ingest_award_file(job, stream=False):
+    '''
+    Read one (xml_source, known_checksum) job from get_ingest_jobs and
+    return (rows, replace): the database rows for the award (see
+    get_award_rows) plus its new ingest manifest row, and whether the award
+    was ingested before, in which case its old rows have to be replaced.
+    If the contents turn out to be unchanged (same checksum), only the
+    manifest row is returned. Module-level so that it can be handed to a
+    multiprocessing pool.
+    '''
+    (xml_source, known_checksum) = job
+    checksum = get_xml_source_checksum(xml_source)
+    rows = {}
+    if checksum != known_checksum:
+        award = parse_award_file(xml_source, stream=stream)
+        rows = get_award_rows(award)
+    (size, mtime, _) = get_xml_source_stat(xml_source)
+    ingested_at = time.strftime('%Y-%m-%d %H:%M:%S')
+    # The manifest row goes last, so it is never committed without the
+    # award's rows.
+    rows['ingest_manifest'] = [(get_xml_source_name(xml_source), size, mtime,
+                                checksum, ingested_at)]
+    return (rows, known_checksum is not None)
+
+
+def add_ingested_award(ingested, writer):
+    '''
+    Queue the result of ingest_award_file for insertion through "writer" (a
+    bulk_writer.BulkWriter), first deleting the old investigator, institution
+    and organization rows of a re-ingested award so they aren't duplicated.
+    '''
+    (rows, replace) = ingested
+    if replace and rows.get('awards'):
+        award_id = rows['awards'][0][0]
+        for table in ['investigators', 'institutions', 'organizations']:
+            writer.delete(table, 'award_id', award_id)
+    writer.add_rows(rows)
+
+
+def write_awards_from_queue(award_queue, db_filename, batch_size=10000):
+    '''
+    Database writer for run_parallel_scraper. Takes ingested awards (as
+    returned by ingest_award_file) off award_queue and writes them to the
+    database until it receives None, committing every batch_size rows. Only
+    this process ever opens the database for writing, since SQLite allows a
+    single writer at a time.
+    '''
+    (conn, c) = init_db(db_filename)
+    writer = BulkWriter(conn, SCRAPER_TABLE_COLUMNS, batch_size=batch_size)
+    ingested = award_queue.get()
+    while ingested is not None:
+        add_ingested_award(ingested, writer)
+        ingested = award_queue.get()
+    writer.close() # Save database
+    conn.close() # Close database
+
+
+def get_manifest(db_filename):
+    '''
+    Create the NSF award database and its ingest manifest if needed, and
+    return the manifest (see load_manifest).
+    '''
+    (conn, c) = init_db(db_filename)
+    init_manifest(c)
+    manifest = load_manifest(c)
+    conn.commit()
+    conn.close()
+    return manifest
+
+
+def get_year_jobs(year, manifest):
+    '''
+    Get the data path and the ingest jobs (see get_ingest_jobs) for a single
+    year, reporting how many files are already up to date.
+    '''
+    (data_path, xml_list) = get_xml_sources(year)
+    jobs = get_ingest_jobs(xml_list, manifest)
+    print('Processing path: ' + data_path + ' ({} of {} files new or '
+          'changed)'.format(len(jobs), len(xml_list)))
+    return (data_path, jobs)
+
+
+def queue_for_writer(award_queue, item, writer, db_filename):
+    '''
+    Put item on award_queue for the writer process of run_parallel_scraper,
+    waiting while the queue is full but raising a RuntimeError instead of
+    waiting forever if the writer has died (e.g. disk full or a locked
+    database).
+    '''
+    while True:
+        try:
+            award_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            if not writer.is_alive():
+                # Nothing will read what is left in the queue, so don't
+                # wait for it to be sent when this process exits.
+                award_queue.cancel_join_thread()
+                raise RuntimeError('Database writer process failed for ' +
+                                   db_filename)
+
+
+def run_parallel_scraper(years, db_filename, workers, stream=False,
+                         batch_size=10000):
+    '''
+    Same as run_scraper, but parses the XML files on a pool of worker
+    processes. Parsed award rows are passed through a queue to a single
+    writer process (write_awards_from_queue) that inserts them into the
+    database.
+    '''
+    manifest = get_manifest(db_filename)
+    award_queue = multiprocessing.Queue(maxsize=workers * 100)
+    writer = multiprocessing.Process(target=write_awards_from_queue,
+                                     args=(award_queue, db_filename,
+                                           batch_size))
+    writer.start()
+    ingest = functools.partial(ingest_award_file, stream=stream)
+    try:
+        with multiprocessing.Pool(workers, reset_open_archives) as pool:
+            for year in years:
+                (data_path, jobs) = get_year_jobs(year, manifest)
+                for ingested in pool.imap_unordered(ingest, jobs,
+                                                    chunksize=64):
+                    queue_for_writer(award_queue, ingested, writer,
+                                     db_filename)
+                print('Completed path: ' + data_path)
+    finally:
+        # Always let the writer finish, so awards parsed before an error
+        # are still saved. Leaving the with block above has already
+        # terminated the pool if the writer died.
+        if writer.is_alive():
+            try:
+                queue_for_writer(award_queue, None, writer, db_filename)
+            except RuntimeError:
+                pass
+        writer.join()
+    if writer.exitcode != 0:
+        raise RuntimeError('Database writer process failed for ' + db_filename)
+
+
+def run_scraper(years, db_filename, stream=False, workers=1,
+                batch_size=10000):
+    '''
+    Scrape all XML files for the given years into the database, reading
+    them from each year's downloaded zip archive where present (see
+    get_xml_sources). Files already recorded unchanged in the ingest manifest
+    are skipped (see init_manifest). With
+    stream=True, files are parsed with lxml's iterparse
+    (get_award_from_xml_filename) instead of building a BeautifulSoup tree.
+    With workers > 1, parsing is spread over that many processes (see
+    run_parallel_scraper). Rows are committed every batch_size rows.
+    '''
+    if workers > 1:
+        run_parallel_scraper(years, db_filename, workers, stream=stream,
+                             batch_size=batch_size)
+        return
+
+    manifest = get_manifest(db_filename)
     (conn, c) = init_db(db_filename)
+    writer = BulkWriter(conn, SCRAPER_TABLE_COLUMNS, batch_size=batch_size)
 
     for year in years:
-        data_path = 'data/nsf/{}/'.format(year)
-        xml_list = get_list_of_xml_filenames(data_path)
-        print('Processing path: ' + data_path)
-        for xml_file in xml_list:
-            soup = get_soup_from_xml_filename(xml_file)
-            award_dict = parse_soup(soup)
-            add_award_to_db(award_dict, c)
+        (data_path, jobs) = get_year_jobs(year, manifest)
+        for job in jobs:
+            ingested = ingest_award_file(job, stream=stream)
+            add_ingested_award(ingested, writer)
         print('Completed path: ' + data_path)
 
-    conn.commit() # Save database
+    writer.close() # Save database
     conn.close() # Close database
 
 
 if __name__=="__main__":
 
-    num_args = len(sys.argv)
-
-    usage = ("usage: python3 " + sys.argv[0] + "<database.db> <Year1> <Year2> ..." +
+    usage = ("usage: python3 " + sys.argv[0] + " [--stream] [--workers N] <database.db> <Year1> <Year2> ..." +
             "\n\t Builds NSF database by scraping downloaded XML files. \
              \n\t Specify database file name and years of NSF data to scrape. \
-             \t .XML files must be found in paths of the form 'data/nsf/<Year>'")
+             \t .XML files must be found in archives of the form 'data/nsf/<Year>.zip' \
+             \t or paths of the form 'data/nsf/<Year>'; a .zip path may be given instead of a year \
+             \n\t --stream parses files with lxml iterparse instead of BeautifulSoup \
+             \n\t --workers N parses files on N processes with a single database writer")
+
+    args = sys.argv[1:]
+    stream = '--stream' in args
+    args = [arg for arg in args if arg != '--stream']
+    workers = 1
+    if '--workers' in args:
+        idx = args.index('--workers')
+        try:
+            workers = int(args[idx + 1])
+        except (IndexError, ValueError):
+            print(usage)
+            sys.exit(0)
+        del args[idx:idx + 2]
 
-    if num_args < 3:
+    if len(args) < 2:
         print(usage)
         sys.exit(0)
     else:
-        db_filename = sys.argv[1]
+        db_filename = args[0]
         years = []
-        for idx in range(2, num_args):
-            years.append(int(sys.argv[idx]))
+        for arg in args[1:]:
+            if arg.endswith('.zip'):
+                years.append(arg)
+            else:
+                years.append(int(arg))
         print(years, db_filename)
-        run_scraper(years, db_filename)
+        run_scraper(years, db_filename, stream=stream, workers=workers)
     
\ No newline at end of file
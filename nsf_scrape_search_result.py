@@ -6,6 +6,7 @@
 import os
 import bs4
 import sqlite3
+from bulk_writer import BulkWriter, AWARD_TABLE_COLUMNS
 
 
 def get_soup_from_xml_filename(fn):
@@ -80,10 +81,12 @@ def init_db(db_filename):
     return (conn, c)
 
 
-def add_award_to_db(award, c):
+def get_award_rows(award):
     '''
     Take in a dictionary (award), which contains all of the fields parsed from
-    a single XML file, and insert all fields into the NSF database.
+    a single award in the search XML file, and return the rows to insert into
+    each table of the NSF database as a dictionary mapping table name : list
+    of rows (ordered as in bulk_writer.AWARD_TABLE_COLUMNS).
     '''
     award_id = int(award.get('awardnumber', None))
     title = award.get('title', '').\
@@ -94,10 +97,8 @@ def add_award_to_db(award, c):
     start_date = award.get('startdate', '')
     end_date = award.get('enddate', '')
 
-    c.execute('''INSERT OR REPLACE INTO awards (award_id, title, abstract,
-                                                amount, start_date, end_date)
-                 VALUES (?, ?, ?, ?, ?, ?);''',
-                 (award_id, title, abstract, amount, start_date, end_date))
+    rows = {'awards': [(award_id, title, abstract, amount, start_date,
+                        end_date)]}
 
     name = award.get('principalinvestigator', '').replace('\'', '').replace('\"', '')
     if isinstance(name, str):
@@ -116,10 +117,7 @@ def add_award_to_db(award, c):
     email = award.get('piemailaddress', '').replace('\'', '').replace('\"', '')
     role = 'PI'
 
-    c.execute('''INSERT OR REPLACE INTO investigators (award_id, last_name,
-                     first_name, role, email)
-                     VALUES (?, ?, ?, ?, ?);''',
-                     (award_id, last_name, first_name, role, email))
+    rows['investigators'] = [(award_id, last_name, first_name, role, email)]
 
     name = award.get('organization', '').replace('\'', '').replace('\"', '')
     city = award.get('organizationcity', '').replace('\'', '').replace('\"', '')
@@ -128,31 +126,38 @@ def add_award_to_db(award, c):
     country = ''
     address = award.get('organizationstreet', '').replace('\'', '').replace('\"', '')
 
-    c.execute('''INSERT OR REPLACE INTO institutions (award_id, name,
-                 city, address, state, zipcode, country)
-                 VALUES (?, ?, ?, ?, ?, ?, ?);''',
-                 (award_id, name, city, address, state_code, zipcode, country))
+    rows['institutions'] = [(award_id, name, address, city, state_code,
+                             zipcode, country)]
 
     organization_code = None
     directorate = award.get('nsfdirectorate', None)
     division = award.get('nsforganization', None)
 
-    c.execute('''INSERT OR REPLACE INTO organizations (award_id,
-                     organization_code, directorate, division)
-                     VALUES (?, ?, ?, ?);''',
-                     (award_id, organization_code, directorate, division))
+    rows['organizations'] = [(award_id, organization_code, directorate,
+                              division)]
+    return rows
+
+
+def add_award_to_db(award, writer):
+    '''
+    Take in a dictionary (award), which contains all of the fields parsed from
+    a single award in the search XML file, and queue all fields for insertion
+    into the NSF database through "writer" (a bulk_writer.BulkWriter).
+    '''
+    writer.add_rows(get_award_rows(award))
 
 
 def run_search_scraper(search_xml_file, db_filename):
     '''
     '''
     (conn, c) = init_db(db_filename)
+    writer = BulkWriter(conn, AWARD_TABLE_COLUMNS)
     soup = get_soup_from_xml_filename(search_xml_file)
     award_dict_list = parse_soup(soup)
     for award_dict in award_dict_list:
-        add_award_to_db(award_dict, c)
+        add_award_to_db(award_dict, writer)
     # print('Completed parsing file: ' + search_xml_file)
-    conn.commit() # Save database
+    writer.close() # Save database
     conn.close() # Close database
 
 
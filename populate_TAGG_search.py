@@ -4,9 +4,9 @@
 # 
 # Python functions to interact with the DHHS's TAGG Advanced Search form so
 # that search returns contain data as we desire. Expects to interact with
-# objects from JS_browser wrapper for Selenium Webdriver and pyVirtualDisplay.
-
-import time
+# objects from JS_browser wrapper for Selenium Webdriver and pyVirtualDisplay,
+# or with a taggs_http.TAGGS_client, which makes the same clicks on the form
+# without a browser and only contacts the server when the search is made.
 
 
 def search(browser, years = [], agency = ['NIH', 'CDC'], states = [],
@@ -15,7 +15,8 @@ def search(browser, years = [], agency = ['NIH', 'CDC'], states = [],
     Makes a series of calls to other functions in this file to populate all the
     relevant fields of the TAGGS Advanced Search pages and then click the
     search button to navigate a JS_browser instance to the first page of the
-    search results.
+    search results. Each of those functions ticks all of its checkboxes in
+    one go (see JS_browser.click_all).
     '''
     select_report_columns(browser)
     select_fiscal_years(browser, years)
@@ -48,8 +49,7 @@ def select_report_columns(browser):
                     '//*[@id="cbl_Columns_RB6_I"]',  # + Action Issue Date
                     '//*[@id="cbl_Columns_RB3_I"]',  # - CFDA Program Number
                     '//*[@id="cbl_Columns_RB19_I"]'] # + Principal Investigator
-    for path in delta_paths:
-        browser.click(path)
+    browser.click_all(delta_paths)
 
 
 def select_fiscal_years(browser, years = []):
@@ -69,13 +69,12 @@ def select_fiscal_years(browser, years = []):
     # dictionary, but not so important in the grand scheme of things.
     year_path_dict = option_path_dict(options, paths)
     # 2017 is checked when the page loads. Rectify this.
-    browser.click(year_path_dict["2017"])
-    for year in years:
-        browser.click(year_path_dict[str(year)])
+    browser.click_all([year_path_dict["2017"]] +
+                        [year_path_dict[str(year)] for year in years])
     # Setting year resets some of the other fields. Give everyting time to
-    # reload in response.
-    browser.wait_for_page_to_load()
-    time.sleep(3)
+    # reload in response: wait until the page has stopped loading for a
+    # second, rather than for a fixed time.
+    browser.wait_for_page_to_load(settle = 1)
 
 
 def select_operating_divisions(browser, divisions = []):
@@ -94,8 +93,7 @@ def select_operating_divisions(browser, divisions = []):
     # dictionary, but not so important in the grand scheme of things.
     division_path_dict = option_path_dict(options, paths)
 
-    for division in divisions:
-        browser.click(division_path_dict[division])
+    browser.click_all([division_path_dict[division] for division in divisions])
 
 
 def select_states(browser, states = []):
@@ -120,8 +118,7 @@ def select_states(browser, states = []):
     # dictionary, but not so important in the grand scheme of things.
     state_path_dict = option_path_dict(options, paths)
 
-    for state in states:
-        browser.click(state_path_dict[state])
+    browser.click_all([state_path_dict[state] for state in states])
 
 
 def select_region(browser, usa = True, intl = True):
@@ -138,11 +135,12 @@ def select_region(browser, usa = True, intl = True):
         USofA_path = '//*[@id="lst_Countries_LBI197C"]/input'
         intl_paths = ['//*[@id="lst_Countries_LBI{}C"]/input'.format(x)
                         for x in range(0, 211) if x != 197]
+        paths = []
         if usa:
-            browser.click(USofA_path)
+            paths.append(USofA_path)
         if intl:
-            for path in intl_paths:
-                browser.click(path)
+            paths += intl_paths
+        browser.click_all(paths)
 
 
 def select_keywords(browser, keywords):
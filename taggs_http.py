@@ -0,0 +1,415 @@
+# CS122 Project
+#
+# Vishok Srikanth / MVR
+#
+# Plain HTTP stand-in for JS_browser on the DHHS's TAGGS Advanced Search page.
+# The page is an ASP.NET form built from DevExpress controls: ticking a
+# checkbox only changes the state of the form in the browser, and the server
+# is not involved until a button (Search, Export to CSV, next page) posts the
+# whole form back. TAGGS_client keeps that form state itself, so the same
+# populate_TAGG_search.search and collect_TAGG.process_results calls that
+# drive a browser instead take a handful of requests: loading the page, the
+# search, one per page of results and the export.
+#
+# EXPERIMENTAL: the field encoding below was inferred from the page's markup
+# and the DevExpress client scripts rather than from any documentation, and
+# has not yet been checked against a session recorded from the live site.
+# To verify it (or after TAGGS changes), record a session with
+# RecordingSession and compare it with what TAGGS_client sends (see
+# ReplaySession). test_taggs_http.py only replays synthetic sessions written
+# by hand in test_fixtures/; a session recorded from the live site can be
+# dropped in alongside them.
+
+import os
+import re
+import json
+import requests
+from urllib.parse import urljoin
+from lxml import html as lxml_html
+from requests.structures import CaseInsensitiveDict
+
+START_PAGE = "https://taggs.hhs.gov/SearchAdv"
+
+# Item of a DevExpress list box (e.g. lst_FYs_LBI3C, whose input is the
+# checkbox for the fourth fiscal year) or check box list (cbl_Columns_RB4_I).
+LIST_ITEM_ID = re.compile(r'^(\w+?)_(?:LBI(\d+)C|RB(\d+)_I)$')
+# onclick of the pager buttons of the results grid.
+PAGER_ONCLICK = re.compile(r"GVPagerOnClick\('(\w+)','(\w+)'\)")
+# Suffixes DevExpress adds to the ID of a control for its inner elements,
+# e.g. btn_AdvSearch_CD is the clickable part of the btn_AdvSearch button.
+INNER_ELEMENT_SUFFIXES = ("_CD", "_B", "_I")
+# Content types of a CSV export; anything else (e.g. the search form sent
+# back with an error) is only taken as a download if sent as an attachment.
+CSV_CONTENT_TYPES = ("text/csv", "application/csv",
+                        "text/comma-separated-values")
+
+
+class Element:
+
+    def __init__(self, element):
+        '''
+        What TAGGS_client._find returns: wraps an lxml element so that, as
+        with a Selenium element, "text" is all of the text it displays.
+        '''
+        self.element = element
+        self.text = element.text_content().strip()
+
+
+class TAGGS_client:
+
+    def __init__(self, save_path, start_link = False, session = None,
+        verbose = False):
+        '''
+        Open an HTTP session for the TAGGS Advanced Search page, optionally
+        loading a page. Offers the methods of JS_browser used on TAGGS pages.
+        Downloads are written under "save_path", as with JS_browser.
+
+        "session" may be any object with the get/post methods of a requests
+        Session, e.g. a ReplaySession serving recorded responses.
+        '''
+        self._save_path = save_path
+        self._verbose = verbose
+        self._session = session if session is not None else requests.Session()
+        self._url = None
+        self._html = ""
+        self._tree = None
+        self._fields = {}
+        self._selections = {}
+        if start_link:
+            self.go_to(start_link)
+
+
+    def go_to(self, link):
+        '''
+        Load the page at "link".
+        '''
+        response = self._session.get(link, timeout = 120)
+        response.raise_for_status()
+        self._load_page(response)
+        if self._verbose:
+            print("Loaded new page successfully.")
+
+
+    def _load_page(self, response):
+        '''
+        Take the HTML of a response as the current page, and reset the form
+        state to the values it was rendered with.
+        '''
+        self._url = response.url
+        self._html = response.text
+        self._tree = lxml_html.fromstring(self._html)
+        self._fields = {}
+        self._selections = {}
+        if self._tree.forms:
+            form = self._tree.forms[0]
+            self._fields = dict(form.form_values())
+            # form_values leaves out hidden DevExpress checkbox state inputs
+            # without a value; keep them so they can be toggled.
+            for field in form.inputs:
+                if field.name and field.name not in self._fields and \
+                    field.get("type", "text") == "hidden":
+                    self._fields[field.name] = field.get("value", "")
+
+
+    def wait_for_page_to_load(self, settle = 0):
+        '''
+        Nothing loads in the background of a page fetched over HTTP.
+        '''
+        return None
+
+
+    def wait_for_clickable(self, element):
+        '''
+        Nothing loads in the background of a page fetched over HTTP.
+        '''
+        return None
+
+
+    def element_exists(self, element):
+        '''
+        Returns True if an element exists on current page at given XPath, False
+        otherwise.
+        '''
+        return self._find(element) is not None
+
+
+    def _find(self, element):
+        '''
+        Retrieve the element at XPath "element" on the current page (as an
+        Element), if it exists.
+        '''
+        if self._tree is None:
+            return None
+        found = self._tree.xpath(element)
+        if not found:
+            return None
+        return Element(found[0])
+
+
+    def click(self, element):
+        '''
+        Click the element at XPath "element". Clicking a checkbox only
+        changes the form state kept here; clicking anything else posts the
+        form back and loads the resulting page.
+        '''
+        found = self._find(element)
+        if found is None:
+            return None
+        response = self._act_on(found.element)
+        if response is not None:
+            self._load_page(response)
+
+
+    def click_all(self, elements):
+        '''
+        Click every element in the list "elements" (given by XPath), in order.
+        '''
+        for element in elements:
+            self.click(element)
+
+
+    def _act_on(self, element):
+        '''
+        Helper for click and download: toggles "element" if it is a checkbox
+        and returns None, otherwise posts the form back as if "element" had
+        been clicked and returns the response.
+        '''
+        for node in element.iterancestors():
+            if node.get("id") and LIST_ITEM_ID.match(node.get("id")):
+                return self._toggle_item(node.get("id"))
+        if element.get("id") and LIST_ITEM_ID.match(element.get("id")):
+            return self._toggle_item(element.get("id"))
+
+        pager = PAGER_ONCLICK.search(element.get("onclick", ""))
+        if pager:
+            return self._post_back(pager.group(1), pager.group(2))
+        return self._post_back(control_id(element.get("id", "")))
+
+
+    def _toggle_item(self, item_id):
+        '''
+        Flip the checkbox of the list item with ID "item_id". Items with a
+        state input of their own ("C" for checked, "U" for unchecked) are
+        flipped there; otherwise the item's index is added to or removed from
+        the selection of its list, which is sent in the list's "_VI" input.
+        '''
+        match = LIST_ITEM_ID.match(item_id)
+        control = match.group(1)
+        index = int(match.group(2) or match.group(3))
+        own_input = self._tree.xpath('//*[@id="{}"]'.format(item_id))
+        if own_input and own_input[0].get("name"):
+            name = own_input[0].get("name")
+            if own_input[0].get("type") == "checkbox":
+                if name in self._fields:
+                    del self._fields[name]
+                else:
+                    self._fields[name] = own_input[0].get("value", "on")
+            else:
+                self._fields[name] = ("U" if self._fields.get(name) == "C"
+                                        else "C")
+            return None
+
+        if control not in self._selections:
+            self._selections[control] = self._initial_selection(control)
+        self._selections[control] ^= {index}
+        value_input = self._tree.xpath('//*[@id="{}_VI"]'.format(control))
+        name = control + "$VI"
+        if value_input and value_input[0].get("name"):
+            name = value_input[0].get("name")
+        self._fields[name] = encode_list_selection(self._selections[control])
+        return None
+
+
+    def _initial_selection(self, control):
+        '''
+        Indices of the items of list box "control" that are checked on the
+        page as rendered.
+        '''
+        selection = set()
+        items = self._tree.xpath('//*[starts-with(@id, "{}_LBI")]'.format(
+                                    control))
+        for item in items:
+            match = LIST_ITEM_ID.match(item.get("id"))
+            if match and match.group(2) and item.xpath('.//input[@checked]'):
+                selection.add(int(match.group(2)))
+        return selection
+
+
+    def _post_back(self, target, argument = ""):
+        '''
+        Post the form back to the server as if control "target" had raised an
+        event, as ASP.NET's __doPostBack does.
+        '''
+        data = dict(self._fields)
+        data["__EVENTTARGET"] = target
+        data["__EVENTARGUMENT"] = argument
+        action = self._url
+        if self._tree.forms and self._tree.forms[0].get("action"):
+            action = urljoin(self._url, self._tree.forms[0].get("action"))
+        response = self._session.post(action, data = data, timeout = 600)
+        response.raise_for_status()
+        return response
+
+
+    def enter_text(self, element, text):
+        '''
+        Fill in the text field at XPath "element" with "text".
+        '''
+        found = self._find(element)
+        if found is not None and found.element.get("name"):
+            self._fields[found.element.get("name")] = text
+
+
+    def download(self, element, default_save_path, output_path = None,
+        force_dowload_wait = None, is_simple = True, ext = None):
+        '''
+        Click the download button at XPath "element" and save the file sent
+        back to "output_path", or if that is not given, where JS_browser's
+        browser would have saved it ("default_save_path", plus "ext" if the
+        browser's name for the file isn't predictable). The other arguments
+        of JS_browser.download don't apply. Raises a RuntimeError if the
+        response isn't a file (see is_download).
+        '''
+        found = self._find(element)
+        if found is None:
+            raise RuntimeError("No download element at {}".format(element))
+        response = self._act_on(found.element)
+        if response is None or not is_download(response):
+            raise RuntimeError("Clicking {} did not download anything".format(
+                                element))
+        if not output_path:
+            output_path = default_save_path
+            if not is_simple and ext:
+                output_path += ext
+        with open(output_path + ".part", "wb") as f:
+            f.write(response.content)
+        os.replace(output_path + ".part", output_path)
+        if self._verbose:
+            print("Downloaded {}".format(output_path))
+        return None
+
+
+    def cleanup(self):
+        '''
+        Close the HTTP session.
+        '''
+        self._session.close()
+        return None
+
+
+    @property
+    def source(self):
+        '''
+        Return HTML source code of the current page.
+        '''
+        return self._html
+
+
+def control_id(element_id):
+    '''
+    The ID of the DevExpress control an element with ID "element_id" belongs
+    to, which is what it posts back as.
+    '''
+    for suffix in INNER_ELEMENT_SUFFIXES:
+        if element_id.endswith(suffix):
+            return element_id[:-len(suffix)]
+    return element_id
+
+
+def is_download(response):
+    '''
+    True if "response" is a file download: sent as an attachment, or as CSV.
+    A page sent back instead (an error page, or the search form re-rendered)
+    is not.
+    '''
+    disposition = response.headers.get("Content-Disposition", "")
+    content_type = response.headers.get("Content-Type", "")
+    content_type = content_type.split(";")[0].strip().lower()
+    return (disposition.lower().startswith("attachment") or
+            content_type in CSV_CONTENT_TYPES)
+
+
+def encode_list_selection(indices):
+    '''
+    Encodes the checked items of a DevExpress list box, given by their
+    indices, as the value of the list's "_VI" input (inferred: indices in
+    ascending order separated by semicolons).
+    '''
+    return ";".join(str(index) for index in sorted(indices))
+
+
+class ReplaySession:
+
+    def __init__(self, fixture_path):
+        '''
+        Stands in for a requests Session, answering each request with the
+        next of the responses recorded in "fixture_path" by a
+        RecordingSession (its responses.json lists them in order). The
+        requests made are kept in "sent" as (method, url, form data), so they
+        can be compared with the recorded ones.
+        '''
+        self._path = fixture_path
+        with open(os.path.join(fixture_path, "responses.json")) as f:
+            self._responses = json.load(f)
+        self._next = 0
+        self.sent = []
+
+
+    def _respond(self, method, url, data):
+        self.sent.append((method, url, data))
+        if self._next >= len(self._responses):
+            raise RuntimeError("No recorded response left for {} {}".format(
+                                method, url))
+        recorded = self._responses[self._next]
+        self._next += 1
+        response = requests.Response()
+        response.status_code = recorded["status"]
+        response.headers = CaseInsensitiveDict(recorded["headers"])
+        response.url = recorded["url"]
+        response.encoding = recorded.get("encoding")
+        with open(os.path.join(self._path, recorded["body"]), "rb") as f:
+            response._content = f.read()
+        return response
+
+
+    def get(self, url, **kwargs):
+        return self._respond("GET", url, None)
+
+
+    def post(self, url, data = None, **kwargs):
+        return self._respond("POST", url, data)
+
+
+    def close(self):
+        return None
+
+
+class RecordingSession(requests.Session):
+
+    def __init__(self, fixture_path):
+        '''
+        A requests Session that saves every response it receives into
+        "fixture_path", in the format ReplaySession reads, along with the
+        form data that was sent.
+        '''
+        super().__init__()
+        self._path = fixture_path
+        if not os.path.exists(fixture_path):
+            os.makedirs(fixture_path)
+        self._responses = []
+
+
+    def request(self, method, url, *args, **kwargs):
+        response = super().request(method, url, *args, **kwargs)
+        body = "{:03d}.body".format(len(self._responses))
+        with open(os.path.join(self._path, body), "wb") as f:
+            f.write(response.content)
+        self._responses.append({"method": method, "url": response.url,
+                                "status": response.status_code,
+                                "headers": dict(response.headers),
+                                "encoding": response.encoding,
+                                "sent": kwargs.get("data"),
+                                "body": body})
+        with open(os.path.join(self._path, "responses.json"), "w") as f:
+            json.dump(self._responses, f, indent = 1)
+        return response
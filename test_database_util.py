@@ -0,0 +1,280 @@
+# Tests for database_util.py
+#
+# Mark Saddler / MVR
+#
+# Run with "python3 -m unittest test_database_util". The TF-IDF tests need
+# the NLTK stopwords corpus (see ngram_engine.py).
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import database_indexer
+import database_util
+import ngram_engine
+
+# Abstracts sharing some trigrams, so that the search results below have
+# repeated trigrams to rank
+AWARDS = [
+    (1234567, 'Graphene membranes for water filtration',
+     'We study graphene membranes for water filtration in arid regions.'),
+    (1234568, 'Graphene sensors',
+     'Graphene membranes for water filtration can also sense ions.'),
+    (1234569, 'Ocean acidification',
+     'Ocean acidification harms coral reef ecosystems worldwide.'),
+    (1234570, 'Coral reef monitoring',
+     'Coral reef ecosystems are monitored with underwater drones.'),
+    ]
+
+
+def make_award_db(db_filename):
+    '''
+    Creates a small awards database like nsf_scrape.py's, inserting award_ids
+    as ints as the scraper does.
+    '''
+    conn = sqlite3.connect(db_filename)
+    conn.execute('''CREATE TABLE awards
+                    (award_id text,
+                     title text,
+                     abstract text,
+                     amount int,
+                     start_date text,
+                     end_date text,
+                     constraint pk_awards primary key (award_id));''')
+    conn.executemany('INSERT INTO awards VALUES (?, ?, ?, 0, "", "");',
+                     AWARDS)
+    conn.commit()
+    conn.close()
+
+
+class FullTextSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_filename = os.path.join(self.tmp_dir, 'awards.db')
+        make_award_db(self.db_filename)
+        database_indexer.add_and_populate_fts_table(self.db_filename)
+        self.conn = sqlite3.connect(self.db_filename)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def search(self, query):
+        results = database_util.full_text_search(query, self.conn.cursor())
+        return set(award_id for (award_id, score) in results)
+
+    def test_leading_not_is_rejected(self):
+        for query in ['NOT graphene', '(NOT graphene)', 'coral OR NOT reef',
+                      'the NOT graphene']:
+            with self.assertRaises(ValueError):
+                database_util.prepare_fts_query(query)
+
+    def test_and_not_excludes(self):
+        self.assertEqual(database_util.prepare_fts_query('coral AND NOT ocean'),
+                         '"coral" NOT "ocean"')
+        self.assertEqual(self.search('coral AND NOT ocean'), {'1234570'})
+
+    def test_unbalanced_parentheses(self):
+        self.assertEqual(database_util.prepare_fts_query('(graphene OR'),
+                         '"graphene"')
+        self.assertEqual(database_util.prepare_fts_query('graphene)'),
+                         '"graphene"')
+        self.assertEqual(database_util.prepare_fts_query('((graphene)'),
+                         '( "graphene" )')
+        for query in ['(graphene OR', 'graphene)', '((graphene)',
+                      'sensors AND (']:
+            self.assertTrue(self.search(query))
+
+    def test_dangling_operators(self):
+        self.assertEqual(database_util.prepare_fts_query('OR graphene AND'),
+                         '"graphene"')
+        self.assertEqual(database_util.prepare_fts_query('AND OR'), '')
+        self.assertEqual(self.search('AND OR'), set())
+
+    def test_group_next_to_term(self):
+        self.assertEqual(self.search('graphene (sensors OR filtration)'),
+                         {'1234567', '1234568'})
+        self.assertEqual(self.search('(coral) (ocean OR drones)'),
+                         {'1234569', '1234570'})
+
+
+class TfIdfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_filename = os.path.join(self.tmp_dir, 'awards.db')
+        make_award_db(self.db_filename)
+        database_indexer.rebuild_keyword_index(self.db_filename)
+        database_indexer.build_tfidf_model(self.db_filename, min_df=1)
+
+    def tearDown(self):
+        database_util.TFIDF_MODELS.pop(self.db_filename, None)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_int_and_text_award_ids_score_alike(self):
+        model = database_util.load_tfidf_model(self.db_filename)
+        from_text = database_util.tf_idf(['1234567', '1234568'], model)
+        from_int = database_util.tf_idf([1234567, 1234568], model)
+        self.assertTrue(from_text)
+        self.assertEqual(from_int, from_text)
+
+    def test_keyword_index_search_scores_every_match(self):
+        conn = sqlite3.connect(self.db_filename)
+        award_ids = database_util.keyword_search(['graphene'], conn.cursor())
+        conn.close()
+        self.assertEqual(award_ids, {1234567, 1234568})
+
+        model = database_util.load_tfidf_model(self.db_filename)
+        trigrams = database_util.search_database_for_trigrams(
+            self.db_filename, ['graphene'], ranking='tfidf')
+        self.assertEqual(trigrams,
+                         database_util.tf_idf(['1234567', '1234568'], model))
+        self.assertIn(('graphene', 'membranes', 'water'), trigrams[:1])
+
+
+class KeywordIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_filename = os.path.join(self.tmp_dir, 'awards.db')
+        make_award_db(self.db_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def index_rows(self):
+        conn = sqlite3.connect(self.db_filename)
+        rows = conn.execute('SELECT award_id, keyword FROM keyword_index '
+                            'ORDER BY award_id, keyword;').fetchall()
+        conn.close()
+        return rows
+
+    def test_incremental_without_watermark_rebuilds(self):
+        database_indexer.rebuild_keyword_index(self.db_filename)
+        full = self.index_rows()
+        # As if the full rebuild had been interrupted before recording its
+        # watermark
+        conn = sqlite3.connect(self.db_filename)
+        conn.execute('DELETE FROM index_meta;')
+        conn.commit()
+        conn.close()
+        database_indexer.rebuild_keyword_index(self.db_filename,
+                                               incremental=True)
+        self.assertEqual(self.index_rows(), full)
+
+    def test_incremental_indexes_new_awards_only_once(self):
+        database_indexer.rebuild_keyword_index(self.db_filename)
+        conn = sqlite3.connect(self.db_filename)
+        conn.execute('INSERT INTO awards VALUES (1234571, "Kelp forests", '
+                     '"Kelp forests shelter fish.", 0, "", "");')
+        conn.commit()
+        conn.close()
+        database_indexer.rebuild_keyword_index(self.db_filename,
+                                               incremental=True)
+        incremental = self.index_rows()
+        database_indexer.rebuild_keyword_index(self.db_filename)
+        self.assertEqual(incremental, self.index_rows())
+        self.assertIn((1234571, 'kelp'), incremental)
+
+
+class KeywordSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_filename = os.path.join(self.tmp_dir, 'awards.db')
+        make_award_db(self.db_filename)
+        database_indexer.rebuild_keyword_index(self.db_filename)
+        self.conn = sqlite3.connect(self.db_filename)
+        self.keywords = {award_id: database_indexer.get_keywords(title,
+                                                                 abstract)
+                         for (award_id, title, abstract) in AWARDS}
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def expected(self, keyword_list, any_keywords=None,
+                 exclude_keywords=None):
+        if not keyword_list and not any_keywords:
+            return set()
+        return set(award_id for (award_id, keywords) in self.keywords.items()
+                   if set(keyword_list) <= keywords
+                   and (not any_keywords or keywords & set(any_keywords))
+                   and not keywords & set(exclude_keywords or []))
+
+    def test_matches_every_keyword_combination(self):
+        searches = [(['graphene'], None, None),
+                    (['water', 'graphene', 'arid'], None, None),
+                    (['coral', 'reef'], ['drones', 'ions'], None),
+                    (['ecosystems'], None, ['ocean']),
+                    ([], ['arid', 'drones'], ['membranes']),
+                    (['graphene', 'coral'], None, None),
+                    (['graphene', 'unknown'], None, None),
+                    ([], None, ['graphene'])]
+        for (keyword_list, any_keywords, exclude_keywords) in searches:
+            self.assertEqual(database_util.keyword_search(
+                                 keyword_list, self.conn.cursor(),
+                                 any_keywords, exclude_keywords),
+                             self.expected(keyword_list, any_keywords,
+                                           exclude_keywords),
+                             (keyword_list, any_keywords, exclude_keywords))
+
+    def test_query_starts_from_rarest_keyword(self):
+        (sql_query, params) = database_util.build_keyword_query(
+            ['water', 'graphene', 'arid'], self.conn.cursor())
+        self.assertEqual(params[0], 'arid')
+
+    def test_pages(self):
+        pages = list(database_util.keyword_search_pages(
+            ['filtration'], self.conn.cursor(), page_size=1))
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(set(award_id for page in pages
+                             for award_id in page), {1234567, 1234568})
+
+
+class TrigramTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_filename = os.path.join(self.tmp_dir, 'awards.db')
+        make_award_db(self.db_filename)
+        database_indexer.rebuild_keyword_index(self.db_filename)
+        self.text = {award_id: [title, abstract]
+                     for (award_id, title, abstract) in AWARDS}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_table_counts_match_top_ngrams(self):
+        database_indexer.build_trigram_tables(self.db_filename)
+        conn = sqlite3.connect(self.db_filename)
+        for award_ids in [list(self.text), [1234567, 1234568],
+                          ['1234567', '1234568'], [1234570], []]:
+            documents = [text for award_id in award_ids
+                         for text in self.text[int(award_id)]]
+            for (min_rep, max_return) in [(1, 50), (2, 50), (1, 3)]:
+                self.assertEqual(
+                    database_util.get_repeated_trigrams_from_table(
+                        award_ids, conn.cursor(), min_rep, max_return),
+                    ngram_engine.top_ngrams(documents, 3, min_rep,
+                                            max_return),
+                    (award_ids, min_rep, max_return))
+        conn.close()
+
+    def test_search_ranks_alike_with_and_without_tables(self):
+        from_text = database_util.search_database_for_trigrams(
+            self.db_filename, ['graphene'], min_rep=2)
+        database_indexer.build_trigram_tables(self.db_filename)
+        conn = sqlite3.connect(self.db_filename)
+        self.assertTrue(database_util.has_trigram_tables(conn.cursor()))
+        conn.close()
+        self.assertEqual(database_util.search_database_for_trigrams(
+                             self.db_filename, ['graphene'], min_rep=2),
+                         from_text)
+        self.assertIn(('graphene', 'membranes', 'water'), from_text)
+
+
+if __name__ == '__main__':
+    unittest.main()
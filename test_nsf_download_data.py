@@ -0,0 +1,100 @@
+# Tests for nsf_download_data.py
+#
+# Mark Saddler / MVR
+#
+# Run with "python3 -m unittest test_nsf_download_data". The downloads are
+# served by a local HTTP server standing in for the NSF site.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.error
+import http.server
+import nsf_download_data
+
+ARCHIVE = bytes(range(256)) * 400
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves ARCHIVE for any path, honouring "Range: bytes=<start>-" headers,
+    or the status code in the server's "error_code" if it is set. The
+    headers of every request are kept in the server's "requests".
+    '''
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.server.error_code:
+            self.send_error(self.server.error_code)
+            return
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                             start, len(ARCHIVE) - 1, len(ARCHIVE)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(ARCHIVE) - start))
+        self.end_headers()
+        self.wfile.write(ARCHIVE[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), ArchiveHandler)
+        self.server.requests = []
+        self.server.error_code = None
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = ('http://127.0.0.1:{}/download?'
+                    'DownloadFileName=2016'.format(self.server.server_port))
+        self.zip_filename = os.path.join(self.tmp_dir, '2016.zip')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_download(self):
+        self.assertEqual(nsf_download_data.download_zipfile(self.url,
+                                                            self.tmp_dir),
+                         self.zip_filename)
+        with open(self.zip_filename, 'rb') as f:
+            self.assertEqual(f.read(), ARCHIVE)
+        self.assertFalse(os.path.exists(self.zip_filename + '.part'))
+
+    def test_part_file_is_resumed(self):
+        with open(self.zip_filename + '.part', 'wb') as f:
+            f.write(ARCHIVE[:30000])
+        nsf_download_data.download_zipfile(self.url, self.tmp_dir)
+        with open(self.zip_filename, 'rb') as f:
+            self.assertEqual(f.read(), ARCHIVE)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]['Range'], 'bytes=30000-')
+
+    def test_complete_part_file_is_kept(self):
+        with open(self.zip_filename + '.part', 'wb') as f:
+            f.write(ARCHIVE)
+        self.server.error_code = 416
+        nsf_download_data.download_zipfile(self.url, self.tmp_dir)
+        with open(self.zip_filename, 'rb') as f:
+            self.assertEqual(f.read(), ARCHIVE)
+
+    def test_client_error_is_not_retried(self):
+        self.server.error_code = 404
+        with self.assertRaises(urllib.error.HTTPError):
+            nsf_download_data.download_zipfile(self.url, self.tmp_dir)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# Tests for nsf_scrape.py
+#
+# Mark Saddler / MVR
+#
+# Run with "python3 -m unittest test_nsf_scrape". Each test writes a few small
+# award XML files to data/nsf/ in a temporary folder, laid out as
+# nsf_download_data.py leaves them.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import zipfile
+import nsf_scrape
+
+AWARD_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<rootTag>
+<Award>
+<AwardTitle>{title}</AwardTitle>
+<AwardEffectiveDate>09/01/2016</AwardEffectiveDate>
+<AwardExpirationDate>08/31/2019</AwardExpirationDate>
+<AwardAmount>300000</AwardAmount>
+<Organization>
+<Code>08090000</Code>
+<Directorate>
+<LongName>Direct For Biological Sciences</LongName>
+</Directorate>
+<Division>
+<LongName>Div Of Integrative Organismal Sys</LongName>
+</Division>
+</Organization>
+<AbstractNarration>{title} is studied in this award.</AbstractNarration>
+<AwardID>{award_id}</AwardID>
+<Investigator>
+<FirstName>Ann</FirstName>
+<LastName>Lee</LastName>
+<EmailAddress>ann@example.edu</EmailAddress>
+<RoleCode>Principal Investigator</RoleCode>
+</Investigator>
+<Investigator>
+<FirstName>Bob</FirstName>
+<LastName>Smith</LastName>
+<EmailAddress></EmailAddress>
+<RoleCode>Co-Principal Investigator</RoleCode>
+</Investigator>
+<Institution>
+<Name>University of Chicago</Name>
+<CityName>Chicago</CityName>
+<ZipCode>606371</ZipCode>
+<StreetAddress>5801 S Ellis Ave</StreetAddress>
+<CountryName>United States</CountryName>
+<StateCode>IL</StateCode>
+</Institution>
+</Award>
+</rootTag>
+'''
+
+TABLES = ['awards', 'investigators', 'institutions', 'organizations',
+          'ingest_manifest']
+NUM_AWARDS = 12
+# Zip members keep a fixed date, as when an archive is repacked
+ZIP_DATE = (2017, 1, 1, 0, 0, 0)
+
+
+def award_xml(award_id, title=None):
+    if title is None:
+        title = 'Retina wiring {}'.format(award_id)
+    return AWARD_XML.format(award_id=award_id, title=title)
+
+
+def write_award_zip(zip_filename, changed=None):
+    '''
+    Writes NUM_AWARDS awards to zip_filename, with the titles in "changed"
+    (award_id : title) in place of the default ones.
+    '''
+    if changed is None:
+        changed = {}
+    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for award_id in range(1600001, 1600001 + NUM_AWARDS):
+            info = zipfile.ZipInfo('{}.xml'.format(award_id), ZIP_DATE)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, award_xml(award_id,
+                                             changed.get(award_id)))
+    nsf_scrape.reset_open_archives()
+
+
+class ScraperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        os.makedirs('data/nsf')
+        self.zip_filename = 'data/nsf/2016.zip'
+        write_award_zip(self.zip_filename)
+
+    def tearDown(self):
+        nsf_scrape.reset_open_archives()
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def table_rows(self, db_filename, table):
+        conn = sqlite3.connect(db_filename)
+        rows = conn.execute('SELECT * FROM {};'.format(table)).fetchall()
+        conn.close()
+        if table == 'ingest_manifest':
+            # Leave out the time of ingest
+            rows = [row[:-1] for row in rows]
+        return sorted(rows, key=repr)
+
+    def test_parallel_matches_serial(self):
+        nsf_scrape.run_scraper(['2016'], 'serial.db')
+        nsf_scrape.run_scraper(['2016'], 'parallel.db', workers=2,
+                               batch_size=5)
+        for table in TABLES:
+            serial = self.table_rows('serial.db', table)
+            self.assertTrue(serial)
+            self.assertEqual(self.table_rows('parallel.db', table), serial)
+        self.assertEqual(len(self.table_rows('serial.db', 'awards')),
+                         NUM_AWARDS)
+
+    def test_zip_archive_matches_extracted_folder(self):
+        # Without a 2015.zip, the extracted folder is read instead
+        with zipfile.ZipFile(self.zip_filename) as archive:
+            archive.extractall('data/nsf/2015')
+        (data_path, xml_list) = nsf_scrape.get_xml_sources('2015')
+        self.assertEqual(data_path, 'data/nsf/2015/')
+        self.assertEqual(len(xml_list), NUM_AWARDS)
+        nsf_scrape.run_scraper(['2015'], 'folder.db')
+        nsf_scrape.run_scraper(['2016'], 'zip.db')
+        self.assertFalse(os.path.exists('data/nsf/2016'))
+        for table in TABLES[:-1]:
+            self.assertEqual(self.table_rows('zip.db', table),
+                             self.table_rows('folder.db', table))
+        # The manifest records the same checksums either way
+        checksums = [row[::3] for row in self.table_rows('zip.db',
+                                                         'ingest_manifest')]
+        self.assertEqual([row[::3] for row in
+                          self.table_rows('folder.db', 'ingest_manifest')],
+                         checksums)
+
+    def ingest_jobs(self, db_filename):
+        (data_path, xml_list) = nsf_scrape.get_xml_sources('2016')
+        return nsf_scrape.get_ingest_jobs(xml_list,
+                                          nsf_scrape.get_manifest(db_filename))
+
+    def test_second_run_skips_every_file(self):
+        self.assertEqual(len(self.ingest_jobs('awards.db')), NUM_AWARDS)
+        nsf_scrape.run_scraper(['2016'], 'awards.db')
+        before = {table: self.table_rows('awards.db', table)
+                  for table in TABLES}
+        self.assertEqual(self.ingest_jobs('awards.db'), [])
+        nsf_scrape.run_scraper(['2016'], 'awards.db')
+        for table in TABLES:
+            self.assertEqual(self.table_rows('awards.db', table),
+                             before[table])
+
+    def test_changed_file_is_reingested_without_duplicates(self):
+        nsf_scrape.run_scraper(['2016'], 'awards.db')
+        before = {table: self.table_rows('awards.db', table)
+                  for table in TABLES}
+        # Same size and date in the archive, different contents
+        write_award_zip(self.zip_filename, {1600003: 'Retina wirinG 1600003'})
+        jobs = self.ingest_jobs('awards.db')
+        self.assertEqual([nsf_scrape.get_xml_source_name(xml_source)
+                          for (xml_source, checksum) in jobs],
+                         ['1600003.xml'])
+        nsf_scrape.run_scraper(['2016'], 'awards.db')
+        for table in TABLES:
+            self.assertEqual(len(self.table_rows('awards.db', table)),
+                             len(before[table]))
+        conn = sqlite3.connect('awards.db')
+        (title,) = conn.execute('SELECT title FROM awards '
+                                'WHERE award_id = 1600003;').fetchone()
+        conn.close()
+        self.assertEqual(title, 'Retina wirinG 1600003')
+        self.assertEqual(self.ingest_jobs('awards.db'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
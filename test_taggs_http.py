@@ -0,0 +1,86 @@
+# CS122 Project
+#
+# Vishok Srikanth / MVR
+#
+# Tests for taggs_http.py, replaying the synthetic TAGGS sessions in
+# test_fixtures/ (see ReplaySession). They were written by hand in the format
+# RecordingSession saves, with placeholder form state (VS1, EV1, ...), and
+# cut down to the form fields and result elements the scrapers use. They
+# check TAGGS_client against the field encoding taggs_http.py assumes, not
+# against the live site. Run with "python3 -m unittest test_taggs_http".
+
+import os
+import shutil
+import tempfile
+import unittest
+import collect_TAGG
+import populate_TAGG_search
+from taggs_http import TAGGS_client, ReplaySession
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "test_fixtures")
+START_PAGE = "https://taggs.hhs.gov/SearchAdv"
+EXPORT_BUTTON = '//*[@id="btnExportToCSVSearchAdvExport_AdvSearchFilter"]'
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def client(self, fixture):
+        session = ReplaySession(os.path.join(FIXTURES, fixture))
+        client = TAGGS_client(self.tmp_dir + "/", start_link = START_PAGE,
+                                session = session)
+        return (client, session)
+
+    def test_search_export_and_pages(self):
+        (client, session) = self.client("synthetic_taggs_search")
+        populate_TAGG_search.search(client, years = ["2015", "2016"],
+                                    agency = ["NIH"], states = ["IL"],
+                                    usa = True, intl = False,
+                                    keywords = "hiv")
+        (method, url, data) = session.sent[1]
+        self.assertEqual(method, "POST")
+        self.assertEqual(data["__EVENTTARGET"], "btn_AdvSearch")
+        self.assertEqual(data["__VIEWSTATE"], "VS1")
+        # 2017 (checked on load) unticked, 2016 and 2015 ticked
+        self.assertEqual(data["lst_FYs$VI"], "1;2")
+        self.assertEqual(data["s_AbstractText"], "hiv")
+        self.assertEqual(data["cbl_Columns$RB0"], "U")
+        self.assertEqual(data["cbl_Columns$RB4"], "C")
+
+        output_path = os.path.join(self.tmp_dir, "export.csv")
+        client.download(EXPORT_BUTTON, self.tmp_dir + "/TAGGS Export ",
+                        output_path, is_simple = False, ext = ".csv")
+        with open(output_path) as f:
+            self.assertTrue(f.read().startswith("OPDIV,Award Number"))
+
+        award_links = collect_TAGG.award_links_from_search(client)
+        self.assertEqual(len(award_links), 6)
+        (method, url, data) = session.sent[3]
+        self.assertEqual((data["__EVENTTARGET"], data["__EVENTARGUMENT"]),
+                            ("GridView", "PBN"))
+        self.assertEqual(data["__VIEWSTATE"], "VS2")
+        self.assertEqual(len(session.sent), 4)
+
+    def test_paging_stops_when_page_does_not_change(self):
+        (client, session) = self.client("synthetic_taggs_stuck_pager")
+        award_links = collect_TAGG.award_links_from_search(client)
+        self.assertEqual(len(award_links), 3)
+        self.assertEqual(len(session.sent), 2)
+
+    def test_export_that_is_not_a_file_is_rejected(self):
+        (client, session) = self.client("synthetic_taggs_bad_export")
+        output_path = os.path.join(self.tmp_dir, "export.csv")
+        with self.assertRaises(RuntimeError):
+            client.download(EXPORT_BUTTON, self.tmp_dir + "/TAGGS Export ",
+                            output_path, is_simple = False, ext = ".csv")
+        self.assertFalse(os.path.exists(output_path))
+
+
+if __name__ == "__main__":
+    unittest.main()